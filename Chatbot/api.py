@@ -0,0 +1,370 @@
+# api.py
+
+# Headless HTTP API over the same core as the Streamlit UI.
+#
+#   python api.py --host 127.0.0.1 --port 8000
+#
+#   POST /register, /login   {"username", "password"}           -> {"token"}
+#   POST /logout
+#   POST /upload?filename=a.pdf   raw file bytes                 -> {"sha256", "kind", "label", "chars"}
+#                (stored once per content; "attachment" takes that sha256)
+#   POST /chat   {"message", "provider"?, "attachment"?: sha256, "stream"?: true}
+#                -> {"answer", "cached"}, or text/event-stream of {"delta"} events then "done"
+#                   {"answer", "cached", "error"}; 502/503 {"error"} when no provider answered
+#   GET  /history?limit=50&before_id=123                         -> {"turns": [...]}
+#   GET  /search?q=refund&limit=20&offset=0                       -> {"results": [...], "has_more"}
+#   GET  /metrics                                                -> Prometheus text, per-stage latency
+#
+# Authenticated routes take "Authorization: Bearer <token>". Provider calls use
+# the async OpenAI/Groq clients, so one event loop holds many in-flight calls;
+# SQLite and file work runs on a small thread pool and never blocks the loop.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+from blobs import find_ref, read_blob, store_bytes
+from config import (API_MAX_BODY, API_SESSION_TTL, CHAT_WRITE_BEHIND, CHAT_FLUSH_ROWS, CHAT_FLUSH_MS,
+                    CHAT_QUEUE_MAX, CHAT_SYNCHRONOUS)
+from context import estimate_tokens
+from core import MAX_TOKENS, TEMPERATURE, EXTRACT_BUDGET, describe_attachment, prepare_turn, finish_turn
+from extract import UnreadableFile, extract_attachment, find_extractor
+from metrics import tracer
+from search import search_chats, start_backfill
+from providers import DEFAULT_MODELS, aclose_provider_clients, dispatcher
+from scheduler import scheduler
+from shared import state
+from storage import POOL_SIZE, insert_user, user_exists, load_chat_page, enable_write_behind
+
+log = logging.getLogger("api")
+
+_blocking = ThreadPoolExecutor(POOL_SIZE, thread_name_prefix="api-db")
+
+STATUS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+          405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+          502: "Bad Gateway", 503: "Service Unavailable"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message, close=False):
+        super().__init__(message)
+        self.status = status
+        self.close = close  # the rest of the stream cannot be trusted to frame the next request
+
+async def run_blocking(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_blocking, partial(fn, *args, **kwargs))
+
+def int_param(req, name, default):
+    value = req["query"].get(name, [None])[0]
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer")
+
+# ---- Auth --------------------------------------------------------------------
+# Sessions live in the shared state, so any worker behind the balancer
+# accepts a token another one issued
+async def shared(fn, *args):
+    # SQLite-backed shared state can wait on another worker's write lock
+    return await run_blocking(fn, *args) if state.blocking else fn(*args)
+
+async def new_session(username):
+    return await shared(state.session_new, username, API_SESSION_TTL)
+
+async def session_user(req):
+    auth = req["headers"].get("authorization", "")
+    token = auth[7:] if auth.lower().startswith("bearer ") else ""
+    username = await shared(state.session_user, token) if token else None
+    if username is None:
+        raise HTTPError(401, "login required")
+    return username
+
+def credentials(req):
+    body = req["json"]
+    username, password = str(body.get("username", "")).strip(), str(body.get("password", ""))
+    if not username or not password:
+        raise HTTPError(400, "username and password are required")
+    return username, password
+
+async def register(req):
+    username, password = credentials(req)
+    if not await run_blocking(insert_user, username, password):
+        raise HTTPError(400, "username exists")
+    return {"token": await new_session(username)}
+
+async def login(req):
+    username, password = credentials(req)
+    if not await run_blocking(user_exists, username, password):
+        raise HTTPError(401, "invalid credentials")
+    return {"token": await new_session(username)}
+
+async def logout(req):
+    await session_user(req)
+    await shared(state.session_end, req["headers"]["authorization"][7:])
+    return {"ok": True}
+
+# ---- Uploads -----------------------------------------------------------------
+def _store_upload(username, filename, mime, data):
+    # Extracted first: a file that cannot be read is never stored or referenced
+    sha256 = hashlib.sha256(data).hexdigest()
+    extraction = extract_attachment(filename, mime, data, sha256, budget=EXTRACT_BUDGET)
+    store_bytes(data, username, filename, mime)
+    return sha256, extraction
+
+def _load_attachment(username, sha256):
+    # Only the user's own uploads; None if they never uploaded this content
+    ref = find_ref(username, sha256)
+    if ref is None:
+        return None
+    filename, mime = ref
+    # Served from the extraction cache; the bytes are only parsed on a cold cache
+    extraction = extract_attachment(filename, mime, read_blob(sha256), sha256, budget=EXTRACT_BUDGET)
+    return describe_attachment(filename, sha256, extraction)
+
+async def upload(req):
+    username = await session_user(req)
+    filename = req["query"].get("filename", [""])[0]
+    mime = req["headers"].get("content-type", "application/octet-stream")
+    if not filename or find_extractor(filename, mime) is None:
+        raise HTTPError(400, "unsupported or missing filename")
+    try:
+        sha256, extraction = await run_blocking(_store_upload, username, filename, mime, req["body"])
+    except UnreadableFile:
+        raise HTTPError(400, "unreadable file")
+    attachment = describe_attachment(filename, sha256, extraction)
+    return {"sha256": sha256, "kind": extraction.kind, "label": attachment.label, "chars": len(attachment.text)}
+
+# ---- Chat --------------------------------------------------------------------
+async def chat(req):
+    username = await session_user(req)
+    body = req["json"]
+    message = str(body.get("message", "")).strip()
+    if not message:
+        raise HTTPError(400, "message is required")
+    provider = str(body.get("provider", "groq"))
+    if provider.lower() not in DEFAULT_MODELS:
+        raise HTTPError(400, f"unknown provider; one of {', '.join(sorted(DEFAULT_MODELS))}")
+    attachment = None
+    if body.get("attachment"):
+        attachment = await run_blocking(_load_attachment, username, str(body["attachment"]))
+        if attachment is None:
+            raise HTTPError(404, "unknown attachment; upload it first")
+
+    trace = tracer.trace(provider=provider.lower(), model=DEFAULT_MODELS.get(provider.lower()))
+    with trace.span("prompt_build"):
+        turn = await run_blocking(prepare_turn, username, provider, message, attachment)
+    trace.set(prompt_tokens=turn.tokens - MAX_TOKENS, cache_hit=turn.cached is not None)
+    if body.get("stream"):
+        return _chat_events(turn, trace)
+
+    parts, err, done = [], None, False
+    try:
+        with trace.span("provider_call") as span:
+            if turn.cached is not None:
+                parts.append(turn.cached)
+            else:
+                async for delta in scheduler.astream(turn.key, username, turn.tokens, partial(_once, turn)):
+                    parts.append(delta)
+            span.set(completion_tokens=estimate_tokens("".join(parts)))
+        done = True
+    except Exception as e:
+        err = e
+        log.warning("chat failed for %s: %s", username, e)
+    finally:
+        with trace.span("db_commit"):
+            answer, _ = await run_blocking(finish_turn, turn, parts, done, err)
+    if err is not None:
+        raise provider_error(err)
+    return {"answer": answer, "cached": turn.cached is not None}
+
+def provider_error(err):
+    # 503 when the scheduler gave up waiting for a slot (retry later), 502 when
+    # the providers themselves failed. The partial answer is still saved.
+    status = 503 if isinstance(err, TimeoutError) else 502
+    return HTTPError(status, f"AI service unavailable: {err}")
+
+async def _once(turn):
+    # A non-streamed answer as a one-delta stream, so it can go through the scheduler
+    yield await dispatcher.achat(turn.provider, turn.msgs, max_tokens=MAX_TOKENS, temperature=TEMPERATURE)
+
+async def _chat_events(turn, trace):
+    # Server-sent events; the client going away mid-stream closes the upstream
+    # stream and the partial answer is saved as cancelled.
+    parts, err, done = [], None, False
+    try:
+        with trace.span("provider_call") as span:
+            if turn.cached is not None:
+                parts.append(turn.cached)
+                yield {"delta": turn.cached}
+            else:
+                upstream = partial(dispatcher.astream, turn.provider, turn.msgs,
+                                   max_tokens=MAX_TOKENS, temperature=TEMPERATURE)
+                async for delta in scheduler.astream(turn.key, turn.username, turn.tokens, upstream):
+                    parts.append(delta)
+                    yield {"delta": delta}
+            span.set(completion_tokens=estimate_tokens("".join(parts)))
+        done = True
+    except Exception as e:
+        err = e
+        log.warning("stream failed for %s: %s", turn.username, e)
+    finally:
+        with trace.span("db_commit"):
+            answer, _ = await run_blocking(finish_turn, turn, parts, done, err)
+    yield {"event": "done", "answer": answer, "cached": turn.cached is not None,
+           "error": str(provider_error(err)) if err is not None else None}
+
+async def history(req):
+    username = await session_user(req)
+    limit = max(1, min(int_param(req, "limit", 50), 500))
+    rows = await run_blocking(load_chat_page, username, limit, int_param(req, "before_id", None))
+    return {"turns": [{"id": i, "user": u, "attachment": a, "bot": b} for i, u, a, b in rows]}
+
+async def search(req):
+    username = await session_user(req)
+    q = req["query"].get("q", [""])[0]
+    limit = max(1, min(int_param(req, "limit", 20), 100))
+    offset = max(0, int_param(req, "offset", 0))
+    rows, more = await run_blocking(search_chats, username, q, limit, offset)
+    return {"results": [{"id": i, "created_at": t, "user": u, "attachment": a, "bot": b} for i, t, u, a, b in rows],
+            "has_more": more}
+
+async def health(req):
+    return {"ok": True, "breakers": {p: b.state for p, b in dispatcher.breakers.items()},
+            "scheduler": scheduler.stats()}
+
+async def metrics(req):
+    return await run_blocking(tracer.prometheus_text)
+
+ROUTES = {
+    ("POST", "/register"): register,
+    ("POST", "/login"): login,
+    ("POST", "/logout"): logout,
+    ("POST", "/upload"): upload,
+    ("POST", "/chat"): chat,
+    ("GET", "/history"): history,
+    ("GET", "/search"): search,
+    ("GET", "/healthz"): health,
+    ("GET", "/metrics"): metrics,
+}
+
+# ---- HTTP/1.1 plumbing -------------------------------------------------------
+async def read_request(reader):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line", close=True)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(400, "invalid Content-Length", close=True)
+    if length > API_MAX_BODY:
+        raise HTTPError(413, "body too large", close=True)
+    body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    req = {"method": method, "path": url.path, "query": parse_qs(url.query), "headers": headers, "body": body}
+    req["json"] = {}
+    if body and url.path != "/upload":  # every other route takes a JSON body
+        try:
+            req["json"] = json.loads(body)
+        except ValueError:
+            raise HTTPError(400, "invalid JSON")
+        if not isinstance(req["json"], dict):
+            raise HTTPError(400, "JSON body must be an object")
+    return req
+
+def write_json(writer, status, obj, keep_alive=True):
+    write_body(writer, status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json", keep_alive)
+
+def write_body(writer, status, body, content_type, keep_alive=True):
+    writer.write((f"HTTP/1.1 {status} {STATUS.get(status, '')}\r\n"
+                  f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                  f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + body)
+
+async def write_events(writer, events):
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                 b"Connection: close\r\n\r\n")
+    try:
+        async for event in events:
+            name = event.pop("event", None)
+            prefix = f"event: {name}\n" if name else ""
+            writer.write(f"{prefix}data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await writer.drain()
+    finally:
+        await events.aclose()
+
+async def handle_connection(reader, writer):
+    try:
+        while True:
+            try:
+                req = await read_request(reader)
+                if req is None:
+                    break
+                handler = ROUTES.get((req["method"], req["path"]))
+                if handler is None:
+                    known = any(path == req["path"] for _, path in ROUTES)
+                    raise HTTPError(405 if known else 404, "no such route")
+                result = await handler(req)
+            except HTTPError as e:
+                write_json(writer, e.status, {"error": str(e)}, keep_alive=not e.close)
+                await writer.drain()
+                if e.close:
+                    break
+                continue
+            except Exception:
+                log.exception("unhandled error")
+                write_json(writer, 500, {"error": "internal error"}, keep_alive=False)
+                break
+            if hasattr(result, "__aiter__"):
+                await write_events(writer, result)
+                break
+            keep_alive = req["headers"].get("connection", "").lower() != "close"
+            if isinstance(result, str):  # /metrics
+                write_body(writer, 200, result.encode("utf-8"), "text/plain; version=0.0.4", keep_alive)
+            else:
+                write_json(writer, 200, result, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass  # client went away
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    if CHAT_WRITE_BEHIND:
+        enable_write_behind(CHAT_FLUSH_ROWS, CHAT_FLUSH_MS, CHAT_QUEUE_MAX, CHAT_SYNCHRONOUS)
+    await run_blocking(start_backfill)
+    server = await asyncio.start_server(handle_connection, host, port, limit=1 << 16, backlog=1024)
+    log.info("listening on http://%s:%d", host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await aclose_provider_clients()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless chatbot HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(serve(args.host, args.port))
@@ -0,0 +1,212 @@
+# batch.py
+
+# Offline batch runs through the same path as a Send in the UI: attachment
+# extraction, prompt build, rate-limited provider call, save to the DB.
+#
+#   python batch.py prompts.jsonl --out results.jsonl --workers 16
+#
+# One JSON object per input line: {"prompt", "id"?, "username"?, "provider"?,
+# "attachment"?: path}. Results are appended to --out as they finish, one line
+# per item: {"id", "line", "answer", "cached", "ms", "error"}. Re-running with
+# the same --out skips items already answered, so an interrupted run resumes
+# where it stopped. Items that name a username share its chat history, as
+# they would in the UI; the rest are answered without any history, so each
+# prompt stands alone and the answer does not depend on item order.
+
+import argparse
+import json
+import logging
+import mimetypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from blobs import read_blob, release_blobs, store_blob
+from config import BATCH_LIMITS, BATCH_WORKERS, SCHEDULER_MAX_WAIT
+from context import estimate_tokens
+from core import MAX_TOKENS, TEMPERATURE, EXTRACT_BUDGET, describe_attachment, prepare_turn, finish_turn
+from extract import UnreadableFile, extract_attachment, find_extractor
+from metrics import tracer
+from providers import DEFAULT_MODELS, dispatcher
+from scheduler import Scheduler
+from shared import state
+from stats import summarize_ms
+
+log = logging.getLogger("batch")
+
+# ---- Input -------------------------------------------------------------------
+def read_items(path):
+    # Yields (line number, item) one line at a time; a malformed line yields
+    # its parse error as the item so it is reported rather than aborting the run.
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict) or not str(item.get("prompt", "")).strip():
+                    raise ValueError("expected an object with a non-empty \"prompt\"")
+            except ValueError as e:
+                item = e
+            yield line_no, item
+
+def completed_ids(out_path):
+    # Ids already answered in an earlier run of the same output file
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by the interruption
+            if rec.get("error") is None:
+                done.add(rec["id"])
+    return done
+
+def item_id(line_no, item):
+    return str(item.get("id", line_no)) if isinstance(item, dict) else str(line_no)
+
+# ---- Runner ------------------------------------------------------------------
+class BatchRunner:
+    """Runs items on a thread pool and appends each result as it finishes.
+
+    Each provider gets its own Scheduler, so items queue against that
+    provider's limits (shared by concurrent batch runs when SHARED_STATE_DB
+    is set) and identical prompts in flight share one call.
+    """
+
+    def __init__(self, out, default_user="batch", default_provider="groq", limits=BATCH_LIMITS):
+        self.out = out
+        self.default_user = default_user
+        self.default_provider = default_provider
+        self.limits = {p: Scheduler(rpm, tpm, rpm, tpm, SCHEDULER_MAX_WAIT, state, f"batch-{p}")
+                       for p, (rpm, tpm) in limits.items()}
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.counts = {"ok": 0, "failed": 0, "cached": 0}
+        self.by_provider = {}
+        self.tokens = 0
+
+    def run_item(self, line_no, item):
+        start = time.perf_counter()
+        rec = {"id": item_id(line_no, item), "line": line_no, "answer": None, "cached": False, "error": None}
+        provider = None
+        try:
+            if isinstance(item, Exception):
+                raise item
+            name = str(item.get("provider", self.default_provider)).lower()
+            if name not in DEFAULT_MODELS:
+                raise ValueError(f"unknown provider {name!r}; one of {', '.join(sorted(DEFAULT_MODELS))}")
+            provider = name
+            answer, cached, tokens = self._answer(item, provider)
+            rec.update(answer=answer, cached=cached)
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"
+            tokens = 0
+        rec["ms"] = round((time.perf_counter() - start) * 1000, 1)
+        self._write(rec, provider, tokens, time.perf_counter() - start)
+        return rec
+
+    def _answer(self, item, provider):
+        username = str(item.get("username", self.default_user))
+        attachment = _load_attachment(username, item["attachment"]) if item.get("attachment") else None
+        trace = tracer.trace(provider=provider, model=DEFAULT_MODELS.get(provider))
+        limiter = self.limits.get(provider) or self.limits[self.default_provider]
+        with trace.span("prompt_build"):
+            turn = prepare_turn(username, provider, str(item["prompt"]), attachment, history="username" in item)
+        trace.set(prompt_tokens=turn.tokens - MAX_TOKENS, cache_hit=turn.cached is not None)
+        with trace.span("provider_call") as span:
+            if turn.cached is not None:
+                parts = [turn.cached]
+            else:
+                parts = list(limiter.stream(turn.key, username, turn.tokens, lambda: [
+                    dispatcher.chat(provider, turn.msgs, max_tokens=MAX_TOKENS, temperature=TEMPERATURE)]))
+            span.set(completion_tokens=estimate_tokens("".join(parts)))
+        # Failures raise above and are not saved, so a resumed run retries them
+        with trace.span("db_commit"):
+            answer, _ = finish_turn(turn, parts, True, limiter=limiter)
+        return answer, turn.cached is not None, turn.tokens
+
+    def _write(self, rec, provider, tokens, seconds):
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.out.write(line)
+            self.out.flush()  # the output file is the checkpoint
+            if rec["error"] is None:
+                self.counts["ok"] += 1
+                self.counts["cached"] += rec["cached"]
+                self.latencies.append(seconds)
+                self.tokens += tokens
+            else:
+                self.counts["failed"] += 1
+            if provider:
+                self.by_provider[provider] = self.by_provider.get(provider, 0) + 1
+
+def _load_attachment(username, path):
+    filename = os.path.basename(path)
+    mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if find_extractor(filename, mime) is None:
+        raise ValueError(f"unsupported attachment {filename}")
+    with open(path, "rb") as f:
+        sha256 = store_blob(f, username, filename, mime)
+    try:
+        extraction = extract_attachment(filename, mime, read_blob(sha256), sha256, budget=EXTRACT_BUDGET)
+    except UnreadableFile:
+        release_blobs(username, sha256)
+        raise
+    return describe_attachment(filename, sha256, extraction)
+
+def run_batch(in_path, out_path, workers=BATCH_WORKERS, default_user="batch", default_provider="groq",
+              limits=BATCH_LIMITS):
+    """Runs every not-yet-answered item of `in_path`; returns the summary dict.
+
+    At most 2 x `workers` items are read ahead of the pool, so memory stays
+    flat however long the input is. Ctrl-C stops reading new items, lets the
+    ones in flight finish and still writes the summary.
+    """
+    done = completed_ids(out_path)
+    skipped = 0
+    wall = time.perf_counter()
+    with open(out_path, "a", encoding="utf-8") as out:
+        runner = BatchRunner(out, default_user, default_provider, limits)
+        pool = ThreadPoolExecutor(workers, thread_name_prefix="batch")
+        pending = set()
+        try:
+            for line_no, item in read_items(in_path):
+                if item_id(line_no, item) in done:
+                    skipped += 1
+                    continue
+                if len(pending) >= 2 * workers:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(pool.submit(runner.run_item, line_no, item))
+            wait(pending)
+        except KeyboardInterrupt:
+            log.warning("interrupted: finishing %d items in flight; re-run to resume", len(pending))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+    wall = time.perf_counter() - wall
+    tracer.flush()
+
+    return {"ok": runner.counts["ok"], "failed": runner.counts["failed"], "cached": runner.counts["cached"],
+            "skipped": skipped, "by_provider": runner.by_provider, "workers": workers,
+            "wall_s": round(wall, 3), "items_per_s": round(runner.counts["ok"] / wall, 2) if wall else 0.0,
+            "tokens_per_s": round(runner.tokens / wall, 1) if wall else 0.0,
+            "latency_ms": summarize_ms(runner.latencies),
+            "coalesced": sum(s.coalesced for s in runner.limits.values())}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the chat pipeline")
+    parser.add_argument("input", help="JSONL, one {\"prompt\", ...} object per line")
+    parser.add_argument("--out", required=True, help="results JSONL; also the checkpoint for resuming")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--user", default="batch", help="username for items without one")
+    parser.add_argument("--provider", default="groq", choices=sorted(DEFAULT_MODELS))
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    summary = run_batch(args.input, args.out, args.workers, args.user, args.provider)
+    print(json.dumps(summary, indent=2, sort_keys=True), file=sys.stderr)
+    sys.exit(1 if summary["failed"] else 0)
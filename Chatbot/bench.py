@@ -0,0 +1,517 @@
+# bench.py
+
+# Offline benchmarks: no API keys and no network. A local stand-in for the
+# OpenAI/Groq chat-completions endpoint serves the provider calls, the DB runs
+# in a scratch file, and attachments are synthetic.
+#
+#   python bench.py --out bench.json
+#   python bench.py --requests 500 --concurrency 32 --latency 0.2 --error-rate 0.05 --out slow.json
+#   python bench.py --compare old.json new.json      # exit 1 on regressions
+#   python bench.py --suites scale --out scale.json  # worker processes vs one; exit 1 if inefficient
+#
+# Output is sorted, indented JSON so two runs can be diffed directly.
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from stats import summarize_ms
+
+# ---- Mock provider -----------------------------------------------------------
+class MockProvider(ThreadingHTTPServer):
+    """OpenAI-compatible /chat/completions server (Groq uses the same shape).
+
+    latency: seconds before the response (or first chunk) with +/- jitter;
+    token_delay: seconds between streamed chunks; error_rate: share of
+    requests answered with a 503.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.05, jitter=0.0, token_delay=0.005, error_rate=0.0, tokens=20, seed=0):
+        super().__init__(("127.0.0.1", 0), _MockHandler)
+        self.latency, self.jitter, self.token_delay = latency, jitter, token_delay
+        self.error_rate, self.tokens = error_rate, tokens
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def plan(self):
+        # Drawn under a lock so a given seed gives the same error pattern
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        return fail, delay
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # clients dropping keep-alive sockets
+            super().handle_error(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="mock-provider", daemon=True).start()
+        return self
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self._send(404, b'{"error": {"message": "not found"}}')
+        server = self.server
+        fail, delay = server.plan()
+        time.sleep(delay)
+        if fail:
+            return self._send(503, b'{"error": {"message": "mock overloaded", "type": "server_error"}}')
+
+        words = [f" tok{i}" for i in range(server.tokens)]
+        base = {"id": "mock", "created": int(time.time()), "model": body.get("model", "mock")}
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": "".join(words).strip()}
+            usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", [])),
+                     "completion_tokens": server.tokens}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            return self._send(200, json.dumps(dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "message": message, "finish_reason": "stop"}])).encode())
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(words):
+            chunk = dict(base, object="chat.completion.chunk", choices=[
+                {"index": 0, "delta": {"content": word}, "finish_reason": None}])
+            self._chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            if i + 1 < len(words):
+                time.sleep(server.token_delay)
+        self._chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+# ---- Measurement -------------------------------------------------------------
+def max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss  # bytes on macOS, KiB elsewhere
+
+def run_workload(name, op, n, concurrency, trace_memory=False):
+    """Call `op(i)` for i in range(n) on `concurrency` threads.
+
+    `op` may return a dict of extra per-call timings in seconds (e.g. "ttft");
+    each one is summarized like the overall latency.
+    """
+    latencies, extras, errors = [], {}, {}
+    lock = threading.Lock()
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            extra = op(i)
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            for k, v in (extra or {}).items():
+                extras.setdefault(k, []).append(v)
+
+    if trace_memory:
+        tracemalloc.start()
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix=f"bench-{name}") as pool:
+        list(pool.map(one, range(n)))
+    wall = time.perf_counter() - wall
+
+    result = {"n": n, "concurrency": concurrency, "ok": len(latencies), "errors": errors,
+              "error_rate": round(1 - len(latencies) / n, 4) if n else 0.0,
+              "wall_s": round(wall, 3), "throughput_per_s": round(len(latencies) / wall, 2) if wall else 0.0,
+              "latency_ms": summarize_ms(latencies), "max_rss_kb": max_rss_kb()}
+    for k, v in extras.items():
+        result[f"{k}_ms"] = summarize_ms(v)
+    if trace_memory:
+        result["traced_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    print(f"{name:<22} {result['throughput_per_s']:>9.1f}/s  p50 {result['latency_ms']['p50']:>9.2f} ms  "
+          f"p99 {result['latency_ms']['p99']:>9.2f} ms  errors {n - len(latencies)}", file=sys.stderr)
+    return result
+
+# ---- Synthetic inputs --------------------------------------------------------
+WORDS = ("invoice total shipping order customer account refund policy warranty battery screen "
+         "delivery payment address update return label support ticket report summary").split()
+
+def synthetic_text(chars, seed):
+    rnd = random.Random(seed)
+    out, size = [], 0
+    while size < chars:
+        word = rnd.choice(WORDS)
+        out.append(word)
+        size += len(word) + 1
+    return " ".join(out)[:chars]
+
+def synthetic_pdf(pages, chars_per_page, seed):
+    # Minimal valid PDF, one Helvetica text line per page
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>",
+            (f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(pages))}] "
+             f"/Count {pages} >>").encode(),
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i in range(pages):
+        text = synthetic_text(chars_per_page, seed * 100003 + i)
+        stream = f"BT /F1 10 Tf 20 700 Td ({text}) Tj ET".encode()
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R "
+                    f">> >> /Contents {5 + 2 * i} 0 R >>".encode())
+        objs.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for n, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (n, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return bytes(out)
+
+# ---- Suites ------------------------------------------------------------------
+def bench_llm(args, results):
+    from providers import DEFAULT_MODELS, _http_client, llm_chat
+    from openai import OpenAI
+
+    mock = MockProvider(args.latency, args.jitter, args.token_delay, args.error_rate, args.tokens, args.seed).start()
+    clients = {"openai": OpenAI(api_key="sk-bench", base_url=mock.url + "/v1",
+                                http_client=_http_client(), max_retries=0)}
+    try:
+        from groq import Groq
+        clients["groq"] = Groq(api_key="gsk_bench", base_url=mock.url, http_client=_http_client(), max_retries=0)
+    except ImportError:
+        print("groq SDK not installed; skipping groq workloads", file=sys.stderr)
+
+    messages = [{"role": "system", "content": "You are a helpful AI assistant."},
+                {"role": "user", "content": synthetic_text(400, args.seed)}]
+    try:
+        for provider, client in clients.items():
+            model = DEFAULT_MODELS[provider]
+
+            def chat(i):
+                llm_chat(provider, client, model, messages)
+
+            def stream(i):
+                start = time.perf_counter()
+                deltas = llm_chat(provider, client, model, messages, stream=True)
+                ttft = None
+                for _ in deltas:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                return {"ttft": ttft or 0.0}
+
+            results[f"llm_chat.{provider}"] = run_workload(f"llm_chat.{provider}", chat, args.requests,
+                                                           args.concurrency, args.trace_memory)
+            results[f"llm_stream.{provider}"] = run_workload(f"llm_stream.{provider}", stream, args.requests,
+                                                             args.concurrency, args.trace_memory)
+    finally:
+        for client in clients.values():
+            client.close()
+        mock.shutdown()
+        mock.server_close()
+
+def bench_db(args, results):
+    import storage
+
+    users = [f"bench{u}" for u in range(args.users)]
+    bot = synthetic_text(600, args.seed)
+    writer = storage.enable_write_behind() if args.write_behind else None
+
+    def save(i):
+        storage.save_chat_to_db(users[i % len(users)], f"question {i}", "", bot)
+
+    def load(i):
+        storage.load_chats_for_user(users[i % len(users)])
+
+    results["db.save_chat"] = run_workload("db.save_chat", save, args.db_rows, args.concurrency, args.trace_memory)
+    if writer is not None:
+        start = time.perf_counter()
+        writer.flush()
+        results["db.save_chat"]["flush_s"] = round(time.perf_counter() - start, 3)
+    results["db.load_chats"] = run_workload("db.load_chats", load, args.db_reads, args.concurrency,
+                                            args.trace_memory)
+
+def bench_extract(args, results):
+    from cache import attachment_hash
+    from extract import extract_attachment
+
+    def extract(filename, mime, data):
+        return extract_attachment(filename, mime, data, attachment_hash(data), budget=args.extract_budget)
+
+    def text_cold(i):
+        extract("bench.txt", "text/plain", synthetic_text(args.text_chars, args.seed + i).encode())
+
+    pdfs = [synthetic_pdf(args.pdf_pages, args.pdf_chars, args.seed + i) for i in range(args.extractions)]
+
+    def pdf_cold(i):
+        extract("bench.pdf", "application/pdf", pdfs[i])
+
+    def pdf_warm(i):
+        extract("bench.pdf", "application/pdf", pdfs[0])  # cached by content hash after pdf_cold
+
+    n, c = args.extractions, args.extract_concurrency
+    results["extract.text_cold"] = run_workload("extract.text_cold", text_cold, n, c, args.trace_memory)
+    results["extract.pdf_cold"] = run_workload("extract.pdf_cold", pdf_cold, n, c, args.trace_memory)
+    results["extract.pdf_warm"] = run_workload("extract.pdf_warm", pdf_warm, n, c, args.trace_memory)
+
+def _scale_worker(db_path, mock_url, prompts, concurrency, doc_chars, history, barrier, out):
+    # One app worker process: prompt build (history from the DB, token
+    # estimates, BM25 passages of an attached document), response cache
+    # lookup, scheduler (shared buckets and call claims), provider call on a
+    # miss, chat save
+    import storage
+    storage.DB_PATH = db_path
+    os.environ["OPENAI_BASE_URL"] = mock_url + "/v1"
+    import providers
+    providers.OPENAI_API_KEY = "sk-bench"
+    from cache import cache_key, response_cache
+    from context import build_messages
+    from retrieval import relevant_context
+    from scheduler import scheduler
+
+    doc = synthetic_text(doc_chars, 7) if doc_chars else ""
+    doc_sha = f"scale-doc-{doc_chars}"
+
+    def op(i):
+        content = prompts[i] + ("\n\n" + relevant_context(doc_sha, doc, prompts[i]) if doc else "")
+        msgs, _ = build_messages(f"scale{i % 20}", "You are a helpful AI assistant.", content, history=history)
+        key = cache_key("openai", providers.DEFAULT_MODELS["openai"], msgs, 0.0, 300)
+        answer = response_cache.get(key)
+        if answer is None:
+            answer = "".join(scheduler.stream(key, f"scale{i % 20}", 400, lambda: [
+                providers.dispatcher.chat("openai", msgs, temperature=0.0)]))
+            response_cache.put(key, answer)
+        storage.save_chat_to_db(f"scale{i % 20}", prompts[i], "", answer)
+
+    providers.get_provider_client("openai")  # SDK import and client setup stay out of the timing
+    response_cache.get("warm-up")
+    if doc:
+        relevant_context(doc_sha, doc, "warm-up")  # index built (or loaded) once, outside the timing
+    barrier.wait()
+    out.put(run_workload(f"scale.pid{os.getpid()}", op, len(prompts), concurrency))
+
+def _run_workers(ctx, db_path, mock, prompt_sets, concurrency, doc_chars, history=True):
+    barrier, out = ctx.Barrier(len(prompt_sets)), ctx.Queue()
+    before = mock.requests
+    procs = [ctx.Process(target=_scale_worker,
+                         args=(db_path, mock.url, prompts, concurrency, doc_chars, history, barrier, out))
+             for prompts in prompt_sets]
+    for p in procs:
+        p.start()
+    workers = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    wall = max(w["wall_s"] for w in workers)
+    ok = sum(w["ok"] for w in workers)
+    n = sum(w["n"] for w in workers)
+    return {"n": n, "ok": ok, "processes": len(procs), "concurrency": concurrency, "wall_s": wall,
+            "throughput_per_s": round(ok / wall, 2) if wall else 0.0, "error_rate": round(1 - ok / n, 4),
+            "upstream_calls": mock.requests - before,
+            # the slowest worker's percentiles
+            "latency_ms": {q: max(w["latency_ms"][q] for w in workers) for q in workers[0]["latency_ms"]}}
+
+def bench_scale(args, results):
+    # Worker processes sharing users.db and a SQLiteState file, as behind a
+    # load balancer. Every request also builds its prompt (history from the
+    # DB, BM25 passages of a --scale-doc-chars document), work that threads in
+    # one process cannot overlap, so each process count is also run as one
+    # process with the same total concurrency ("scale.threadsN"). A last run
+    # sends the same prompts from every process to count provider calls made
+    # twice. Efficiency below --scale-min-efficiency or any duplicate call
+    # fails the run.
+    import multiprocessing
+    import storage
+    from config import CONTEXT_MAX_TURNS
+
+    scratch = os.path.dirname(storage.DB_PATH)
+    os.environ.update(SHARED_STATE_DB=os.path.join(scratch, "shared-state.db"), RESPONSE_CACHE="1",
+                      RETRIEVAL_DIR=os.path.join(scratch, "indexes"),
+                      RATE_GLOBAL_RPM="1000000", RATE_GLOBAL_TPM="1000000000",
+                      RATE_USER_RPM="1000000", RATE_USER_TPM="1000000000")
+    # A full history window per user from the start, so every run loads the same amount
+    for u in range(20):
+        for j in range(CONTEXT_MAX_TURNS):
+            storage.save_chat_to_db(f"scale{u}", synthetic_text(300, u * 1000 + j), "",
+                                    synthetic_text(600, u * 1000 + j + 500))
+    ctx = multiprocessing.get_context("spawn")
+    mock = MockProvider(args.scale_latency, 0.0, args.token_delay, 0.0, args.tokens, args.seed).start()
+    n, c, doc = args.scale_requests, args.scale_concurrency, args.scale_doc_chars
+    try:
+        base = None
+        for procs in sorted({int(p) for p in args.scale_processes.split(",")}):
+            prompt_sets = [[f"{synthetic_text(200, i)} run {procs} worker {w} item {i}" for i in range(n)]
+                           for w in range(procs)]
+            result = _run_workers(ctx, storage.DB_PATH, mock, prompt_sets, c, doc)
+            base = base or result["throughput_per_s"] / procs
+            result["speedup"] = round(result["throughput_per_s"] / base, 2) if base else 0.0
+            result["efficiency"] = round(result["speedup"] / procs, 2)
+            line = (f"scale x{procs:<3} {result['throughput_per_s']:>9.1f}/s  speedup {result['speedup']:.2f} "
+                    f"(efficiency {result['efficiency']:.0%})")
+            if procs > 1:
+                threads = _run_workers(ctx, storage.DB_PATH, mock, [[f"{p} threads {procs}" for pset in prompt_sets
+                                                                     for p in pset]], procs * c, doc)
+                results[f"scale.threads{procs}"] = threads
+                result["vs_one_process"] = round(result["throughput_per_s"] / threads["throughput_per_s"], 2)
+                line += (f"; 1 process x {procs * c} threads {threads['throughput_per_s']:.1f}/s "
+                         f"-> {result['vs_one_process']:.2f}x")
+                if result["efficiency"] < args.scale_min_efficiency:
+                    args.failures.append(f"scale.processes{procs}: efficiency {result['efficiency']:.2f} "
+                                         f"< {args.scale_min_efficiency}")
+            results[f"scale.processes{procs}"] = result
+            print(line, file=sys.stderr)
+
+        procs = max(int(p) for p in args.scale_processes.split(","))
+        shared = [f"{synthetic_text(200, i)} shared item {i}" for i in range(n)]
+        # No history: identical prompts must build identical messages in every process
+        result = _run_workers(ctx, storage.DB_PATH, mock, [shared] * procs, c, doc, history=False)
+        result["unique_prompts"] = n
+        result["duplicate_calls"] = result["upstream_calls"] - n
+        results["scale.shared_prompts"] = result
+        print(f"scale shared  {procs} processes x {n} identical prompts -> {result['upstream_calls']} provider calls",
+              file=sys.stderr)
+        if result["duplicate_calls"]:
+            args.failures.append(f"scale.shared_prompts: {result['duplicate_calls']} duplicate provider calls")
+    finally:
+        mock.shutdown()
+        mock.server_close()
+
+SUITES = {"llm": bench_llm, "db": bench_db, "extract": bench_extract, "scale": bench_scale}
+
+# ---- Regression check --------------------------------------------------------
+def compare(old_path, new_path, threshold):
+    # Latency percentiles going up or throughput going down by more than
+    # `threshold` (a fraction) count as regressions.
+    with open(old_path) as f:
+        old = json.load(f)["results"]
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        checks = [(f"latency_ms.{q}", old[name]["latency_ms"][q], new[name]["latency_ms"][q], 1)
+                  for q in ("p50", "p95", "p99")]
+        checks.append(("throughput_per_s", old[name]["throughput_per_s"], new[name]["throughput_per_s"], -1))
+        for metric, a, b, sign in checks:
+            change = (b - a) / a if a else 0.0
+            bad = sign * change > threshold
+            regressions += bad
+            print(f"{'REGRESSION' if bad else 'ok':<10} {name:<22} {metric:<18} {a:>10.2f} -> {b:>10.2f} "
+                  f"({change:+.1%})")
+    for name in sorted(set(old) ^ set(new)):
+        print(f"{'only in ' + ('old' if name in old else 'new'):<10} {name}")
+    return regressions
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline chatbot benchmarks (mock provider, scratch DB)")
+    parser.add_argument("--suites", default="llm,db,extract", help="comma-separated: " + ",".join(SUITES))
+    parser.add_argument("--out", help="write results JSON here (default: stdout)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="record tracemalloc peaks (slower)")
+    llm = parser.add_argument_group("llm")
+    llm.add_argument("--requests", type=int, default=200)
+    llm.add_argument("--concurrency", type=int, default=16)
+    llm.add_argument("--latency", type=float, default=0.05, help="mock seconds to response/first chunk")
+    llm.add_argument("--jitter", type=float, default=0.01)
+    llm.add_argument("--token-delay", type=float, default=0.002, help="mock seconds between streamed chunks")
+    llm.add_argument("--tokens", type=int, default=20, help="mock completion length in chunks")
+    llm.add_argument("--error-rate", type=float, default=0.0, help="share of mock 503 responses")
+    db = parser.add_argument_group("db")
+    db.add_argument("--users", type=int, default=20)
+    db.add_argument("--db-rows", type=int, default=2000)
+    db.add_argument("--db-reads", type=int, default=500)
+    db.add_argument("--write-behind", action="store_true", help="benchmark the write-behind chat writer")
+    ex = parser.add_argument_group("extract")
+    ex.add_argument("--extractions", type=int, default=20)
+    ex.add_argument("--extract-concurrency", type=int, default=4)
+    ex.add_argument("--extract-budget", type=int, default=4000)
+    ex.add_argument("--text-chars", type=int, default=200000)
+    ex.add_argument("--pdf-pages", type=int, default=30)
+    ex.add_argument("--pdf-chars", type=int, default=1500, help="text per PDF page")
+    sc = parser.add_argument_group("scale (opt-in: --suites scale)")
+    sc.add_argument("--scale-processes", default="1,2,4", help="worker process counts to compare")
+    sc.add_argument("--scale-requests", type=int, default=100, help="requests per worker process")
+    sc.add_argument("--scale-concurrency", type=int, default=4, help="concurrent requests per worker process")
+    sc.add_argument("--scale-latency", type=float, default=0.2, help="mock seconds per provider call")
+    sc.add_argument("--scale-doc-chars", type=int, default=200000,
+                    help="attached document searched for passages on every request (0: none)")
+    sc.add_argument("--scale-min-efficiency", type=float, default=0.7,
+                    help="fail when speedup / processes falls below this")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="diff two result files and exit")
+    parser.add_argument("--threshold", type=float, default=0.10, help="regression threshold for --compare")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(*args.compare, args.threshold) else 0
+
+    # Everything the app persists goes to a scratch directory, never users.db
+    import storage
+    scratch = tempfile.mkdtemp(prefix="chatbot-bench-")
+    storage.DB_PATH = os.path.join(scratch, "bench.db")
+
+    results = {}
+    args.failures = []  # checks a suite found failing; the run exits 1
+    try:
+        for name in args.suites.split(","):
+            SUITES[name.strip()](args, results)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "revision": git_revision(),
+                       "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                       "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "failures")}},
+              "failures": args.failures,
+              "results": results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for failure in args.failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+    return 1 if args.failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# blobs.py
+
+import argparse
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import time
+from config import BLOB_DIR, BLOB_CHUNK_BYTES, THUMB_MAX_PX
+from storage import get_conn
+
+log = logging.getLogger(__name__)
+
+# Uploads are stored once per content, at BLOB_DIR/<sha[:2]>/<sha256>, whatever
+# their name or uploader. blob_refs records who uploaded what under which name;
+# a blob with no refs left is removed by collect_garbage(). Clearing a chat
+# releases that user's refs; run the collector from cron or by hand:
+#
+#   python blobs.py --gc
+
+def blob_path(sha256):
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+# ---- Writes ------------------------------------------------------------------
+def store_blob(fileobj, username, filename, mime=None, chunk_size=BLOB_CHUNK_BYTES):
+    # Streams `fileobj` to a temp file in chunks while hashing it, then moves it
+    # into place unless the same content is already stored. Returns the sha256.
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    digest, size = hashlib.sha256(), 0
+    fd, tmp = tempfile.mkstemp(dir=BLOB_DIR, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        if os.path.exists(path):
+            os.remove(tmp)  # duplicate content: keep the stored copy
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    now = time.time()
+    with get_conn() as conn:
+        conn.execute("INSERT OR IGNORE INTO blobs (sha256, size, mime, created_at) VALUES (?, ?, ?, ?)",
+                     (sha256, size, mime, now))
+        conn.execute("INSERT OR REPLACE INTO blob_refs (username, sha256, filename, created_at) VALUES (?, ?, ?, ?)",
+                     (username, sha256, filename, now))
+    return sha256
+
+def store_bytes(data, username, filename, mime=None):
+    return store_blob(io.BytesIO(data), username, filename, mime)
+
+# ---- Reads -------------------------------------------------------------------
+def read_blob(sha256):
+    with open(blob_path(sha256), "rb") as f:
+        return f.read()
+
+def find_ref(username, sha256):
+    # (filename, mime) of the user's latest upload of this content, or None
+    with get_conn() as conn:
+        return conn.execute("""SELECT r.filename, b.mime FROM blob_refs r JOIN blobs b USING (sha256)
+                               WHERE r.username=? AND r.sha256=? ORDER BY r.created_at DESC LIMIT 1""",
+                            (username, sha256)).fetchone()
+
+# ---- Cleanup -----------------------------------------------------------------
+def release_blobs(username, sha256=None):
+    with get_conn() as conn:
+        if sha256 is None:
+            conn.execute("DELETE FROM blob_refs WHERE username=?", (username,))
+        else:
+            conn.execute("DELETE FROM blob_refs WHERE username=? AND sha256=?", (username, sha256))
+
+def collect_garbage():
+    # Deletes blobs (and their thumbnails) nobody references; returns how many
+    with get_conn() as conn:
+        orphans = [r[0] for r in conn.execute(
+            "SELECT sha256 FROM blobs WHERE sha256 NOT IN (SELECT sha256 FROM blob_refs)")]
+        conn.executemany("DELETE FROM blobs WHERE sha256=?", [(s,) for s in orphans])
+    thumbs = os.path.join(BLOB_DIR, "thumbs")
+    names = os.listdir(thumbs) if os.path.isdir(thumbs) else []
+    for sha256 in orphans:
+        for path in [blob_path(sha256)] + [os.path.join(thumbs, n) for n in names if n.startswith(sha256)]:
+            if os.path.exists(path):
+                os.remove(path)
+    log.info("gc: removed %d unreferenced blobs", len(orphans))
+    return len(orphans)
+
+# ---- Thumbnails --------------------------------------------------------------
+def thumbnail(sha256, max_px=THUMB_MAX_PX):
+    """Path and (width, height) of a preview no larger than max_px a side.
+
+    Built once per blob and size. JPEGs are decoded at reduced scale
+    (draft mode), so a large photo is never fully decoded.
+    """
+    from PIL import Image, ImageOps
+
+    thumbs = os.path.join(BLOB_DIR, "thumbs")
+    for ext in (".jpg", ".png"):
+        path = os.path.join(thumbs, f"{sha256}-{max_px}{ext}")
+        if os.path.exists(path):
+            with Image.open(path) as img:
+                return path, img.size
+
+    with Image.open(blob_path(sha256)) as img:
+        img.draft("RGB", (max_px, max_px))            # JPEG: DCT scaling while decoding
+        img.thumbnail((max_px, max_px), reducing_gap=2.0)  # integer reduce() first, then resample
+        img = ImageOps.exif_transpose(img)
+        alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if alpha:
+            img, ext, options = img.convert("RGBA"), ".png", {"optimize": True}
+        else:
+            img, ext, options = img.convert("RGB"), ".jpg", {"quality": 85, "optimize": True}
+    os.makedirs(thumbs, exist_ok=True)
+    path = os.path.join(thumbs, f"{sha256}-{max_px}{ext}")
+    fd, tmp = tempfile.mkstemp(dir=thumbs, prefix=".thumb-")
+    with os.fdopen(fd, "wb") as f:
+        img.save(f, format="PNG" if alpha else "JPEG", **options)
+    os.replace(tmp, path)
+    return path, img.size
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the upload blob store")
+    parser.add_argument("--release", metavar="USERNAME", help="drop USERNAME's references to their uploads")
+    parser.add_argument("--gc", action="store_true", help="delete blobs no user references any more")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    if args.release:
+        release_blobs(args.release)
+    if args.gc:
+        print(f"removed {collect_garbage()} blobs")
@@ -0,0 +1,112 @@
+# cache.py
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from config import (RESPONSE_CACHE, RESPONSE_CACHE_ANY_TEMPERATURE, RESPONSE_CACHE_MEMORY_ITEMS,
+                    RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB_MAX_BYTES)
+from storage import get_conn
+
+# ---- Keys --------------------------------------------------------------------
+def cache_key(provider, model, messages, temperature, max_tokens, attachment_hash=""):
+    # Normalise what does not change the answer (case of provider/role,
+    # surrounding whitespace, CRLF) so equivalent prompts share one entry.
+    norm = [(m["role"].lower(), m["content"].replace("\r\n", "\n").strip()) for m in messages]
+    payload = json.dumps([provider.lower(), model, norm, float(temperature), int(max_tokens), attachment_hash],
+                         ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def attachment_hash(data):
+    return hashlib.sha256(data).hexdigest() if data else ""
+
+# ---- Two-tier cache ----------------------------------------------------------
+class ResponseCache:
+    """In-memory LRU in front of a SQLite table with TTL and a byte budget."""
+
+    def __init__(self, memory_items=256, ttl=7 * 24 * 3600, db_max_bytes=64 * 1024 * 1024,
+                 any_temperature=False, enabled=True):
+        self.memory_items = memory_items
+        self.ttl = ttl
+        self.db_max_bytes = db_max_bytes
+        self.any_temperature = any_temperature
+        self.enabled = enabled
+        self._lru = OrderedDict()   # key -> (response, created_at)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "skipped": 0, "evictions": 0}
+
+    def cacheable(self, temperature):
+        return self.enabled and (temperature <= 0 or self.any_temperature)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            hit = self._lru.get(key)
+            if hit and now - hit[1] < self.ttl:
+                self._lru.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return hit[0]
+            if hit:
+                del self._lru[key]
+
+        with get_conn() as conn:
+            row = conn.execute("SELECT response, created_at FROM response_cache WHERE key=?", (key,)).fetchone()
+            if row and now - row[1] >= self.ttl:
+                conn.execute("DELETE FROM response_cache WHERE key=?", (key,))
+                row = None
+            elif row:
+                conn.execute("UPDATE response_cache SET last_access=? WHERE key=?", (now, key))
+
+        with self._lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._remember(key, row[0], row[1])
+        return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            self._puts += 1
+            sweep = self._puts % 32 == 0
+        with get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO response_cache (key, response, size, created_at, last_access) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, response, len(response.encode("utf-8")), now, now))
+        if sweep:
+            self.evict()
+
+    def skip(self):
+        with self._lock:
+            self.stats["skipped"] += 1
+
+    def evict(self):
+        # Expired rows first, then least recently used until under the byte budget
+        now = time.time()
+        with get_conn() as conn:
+            n = conn.execute("DELETE FROM response_cache WHERE created_at<?", (now - self.ttl,)).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+            if total > self.db_max_bytes:
+                victims, excess = [], total - self.db_max_bytes
+                for key, size in conn.execute("SELECT key, size FROM response_cache ORDER BY last_access"):
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM response_cache WHERE key=?", victims)
+                n += len(victims)
+        with self._lock:
+            self.stats["evictions"] += n
+
+    def _remember(self, key, response, created_at):
+        self._lru[key] = (response, created_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.memory_items:
+            self._lru.popitem(last=False)
+            self.stats["evictions"] += 1
+
+response_cache = ResponseCache(RESPONSE_CACHE_MEMORY_ITEMS, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB_MAX_BYTES,
+                               RESPONSE_CACHE_ANY_TEMPERATURE, RESPONSE_CACHE)
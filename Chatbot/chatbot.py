@@ -1,128 +1,147 @@
 # chatbot.py
 
 import os
+import logging
 import streamlit as st
-import sqlite3
-from PIL import Image
-from openai import OpenAI
-from groq import Groq
-from config import OPENAI_API_KEY, GROQ_API_KEY
-
-# Optional PDF extraction
-try:
-    import PyPDF2
-    _HAS_PYPDF2 = True
-except Exception:
-    _HAS_PYPDF2 = False
-
-# ---- LLM provider helpers ----------------------------------------------------
-def get_provider_client(provider: str):
-    provider = provider.lower()
-    if provider == "openai":
-        if not OPENAI_API_KEY or not OPENAI_API_KEY.startswith("sk-"):
-            return None, None, "OpenAI key missing/invalid. Set OPENAI_API_KEY (starts with 'sk-')."
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            return client, "gpt-3.5-turbo", None
-        except Exception as e:
-            return None, None, f"Failed to init OpenAI client: {e}"
-
-    if not GROQ_API_KEY or not GROQ_API_KEY.startswith("gsk_"):
-        return None, None, "Groq key missing/invalid. Set GROQ_API_KEY (starts with 'gsk_')."
-    try:
-        from groq import Groq
-        client = Groq(api_key=GROQ_API_KEY)
-        return client, "llama-3.1-8b-instant", None
-    except Exception as e:
-        return None, None, f"Failed to init Groq client: {e}"
-
-def llm_chat(provider: str, client, model: str, messages, max_tokens=300, temperature=0.7):
-    resp = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
-    return resp.choices[0].message.content.strip()
-
-# ---- App folders -------------------------------------------------------------
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-DB_PATH = "users.db"
-
-# ---- DB helpers --------------------------------------------------------------
-def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
-
-def create_users_table():
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)")
-        conn.commit()
-
-def insert_user(username, password):
+from providers import get_provider_client, dispatcher
+from scheduler import scheduler
+from shared import state
+from blobs import release_blobs, store_blob, thumbnail
+from metrics import tracer
+from search import search_chats, start_backfill
+from storage import insert_user, user_exists, load_chat_page, load_chat_turn, delete_user_chats, enable_write_behind
+from cache import response_cache
+from extract import UnreadableFile, extract_attachment
+from retrieval import HAS_RETRIEVAL, get_index
+from context import estimate_tokens
+from core import (MAX_TOKENS, TEMPERATURE, EXTRACT_BUDGET, describe_attachment, prepare_turn, finish_turn)
+from config import (API_SESSION_TTL, CHAT_WRITE_BEHIND, CHAT_FLUSH_ROWS, CHAT_FLUSH_MS, CHAT_QUEUE_MAX, CHAT_SYNCHRONOUS,
+                    EXTRACT_MAX_CHARS, ADMIN_USERS, SEARCH_PAGE_SIZE, HISTORY_PAGE_SIZE, HISTORY_VISIBLE,
+                    HISTORY_PREVIEW_CHARS, HISTORY_BODY_CACHE, SHARED_STATE_DB)
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per provider request otherwise
+
+# ---- Streaming UI helpers ----------------------------------------------------
+def render_stream(deltas, placeholder, parts):
+    # Deltas are collected into the caller's `parts` so a partial answer
+    # survives a mid-stream error or a Streamlit stop/rerun.
     try:
-        with get_conn() as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO users VALUES (?, ?)", (username, password))
-            conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-
-def user_exists(username, password):
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM users WHERE username=? AND password=?", (username, password))
-        return c.fetchone() is not None
-
-def create_chat_table():
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT,
-                user_text TEXT,
-                attachment_summary TEXT,
-                bot_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-
-def save_chat_to_db(username, user_text, attachment_summary, bot_text):
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO chats (username, user_text, attachment_summary, bot_text) VALUES (?, ?, ?, ?)",
-                  (username, user_text, attachment_summary, bot_text))
-        conn.commit()
-
-def load_chats_for_user(username, limit=200):
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("""SELECT user_text, attachment_summary, bot_text
-                     FROM chats WHERE username=? ORDER BY id ASC LIMIT ?""",
-                  (username, limit))
-        return c.fetchall()
-
-def delete_user_chats(username):
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM chats WHERE username=?", (username,))
-        conn.commit()
-
-# ---- Init DB -----------------------------------------------------------------
-create_users_table()
-create_chat_table()
+        for delta in deltas:
+            parts.append(delta)
+            placeholder.markdown(f"**AI:** {''.join(parts)}▌")
+    finally:
+        deltas.close()
+    placeholder.markdown(f"**AI:** {''.join(parts)}")
+
+# ---- History helpers ---------------------------------------------------------
+# chat_history holds only (id, preview) per turn, oldest first; full bodies
+# are read back from the DB when a turn is rendered. Turns without a DB id yet
+# (queued for write-behind) get a local negative id and keep their body in
+# pending_bodies until settle_pending() finds the saved row.
+def keyed_turns(rows):
+    out = []
+    for chat_id, u, a, b in rows:
+        if chat_id is None:
+            st.session_state.local_turn_id -= 1
+            chat_id = st.session_state.local_turn_id
+            st.session_state.pending_bodies[chat_id] = (u, a, b)
+        preview = u if len(u) <= HISTORY_PREVIEW_CHARS else u[:HISTORY_PREVIEW_CHARS].rstrip() + "…"
+        out.append((chat_id, preview))
+    return out
+
+def load_history(before_id=None):
+    # The newest page, or the page before `before_id` prepended to chat_history
+    rows = load_chat_page(st.session_state.username, HISTORY_PAGE_SIZE, before_id)
+    st.session_state.history_more = len(rows) == HISTORY_PAGE_SIZE
+    if before_id is None:
+        st.session_state.pending_bodies = {}
+    st.session_state.chat_history = keyed_turns(rows) + (st.session_state.chat_history if before_id else [])
+
+def settle_pending():
+    # Swaps local ids for real ones once the writer has flushed those turns,
+    # so their bodies need not stay in the session
+    pending = st.session_state.pending_bodies
+    if not pending:
+        return
+    by_body = {(u, a or None, b): local_id for local_id, (u, a, b) in pending.items()}
+    real = {}
+    for chat_id, u, a, b in load_chat_page(st.session_state.username, len(pending)):
+        local_id = by_body.pop((u, a or None, b), None) if chat_id is not None else None
+        if local_id is not None:
+            real[local_id] = chat_id
+            del pending[local_id]
+    if real:
+        st.session_state.chat_history = [(real.get(i, i), preview) for i, preview in st.session_state.chat_history]
+
+def format_turn(u, a, b):
+    # One st.markdown per turn instead of three
+    return f"**You:** {u}" + (f"  \n_Attachment:_ {a}" if a else "") + f"  \n**AI:** {b}\n\n---"
+
+@st.cache_data(max_entries=HISTORY_BODY_CACHE, show_spinner=False)
+def saved_turn_markdown(username, chat_id):
+    # Process-wide and bounded, so memory does not grow with sessions x turns.
+    # Chat ids are never reused (AUTOINCREMENT), so entries cannot go stale.
+    row = load_chat_turn(username, chat_id)
+    return format_turn(*row) if row else ""
+
+def turn_markdown(turn):
+    chat_id = turn[0]
+    if chat_id < 0:
+        return format_turn(*st.session_state.pending_bodies[chat_id])
+    return saved_turn_markdown(st.session_state.username, chat_id)
+
+# ---- Login helpers -----------------------------------------------------------
+# With several worker processes (SHARED_STATE_DB set) the session token rides
+# in the URL, so a reload that the load balancer sends to another worker finds
+# the login in the shared state. A URL ends up in history and logs, so a single
+# worker keeps the login in its Streamlit session only; so can a balancer with
+# sticky sessions, by leaving SHARED_STATE_DB unset.
+URL_SESSIONS = bool(SHARED_STATE_DB)
+
+def log_in(username):
+    if URL_SESSIONS:
+        st.query_params["session"] = state.session_new(username, API_SESSION_TTL)
+    st.session_state.logged_in = True
+    st.session_state.username = username
+    load_history()
+
+def log_out():
+    if "session" in st.query_params:
+        state.session_end(st.query_params["session"])
+        del st.query_params["session"]
+    st.session_state.logged_in = False
+    st.session_state.username = ""
+    st.session_state.chat_history = []
+
+def resume_login():
+    token = st.query_params.get("session") if URL_SESSIONS else None
+    username = state.session_user(token) if token else None
+    if username is None:
+        if token:
+            del st.query_params["session"]  # expired
+        return
+    st.session_state.logged_in = True
+    st.session_state.username = username
+    load_history()
+
+# ---- Startup -----------------------------------------------------------------
+if CHAT_WRITE_BEHIND:
+    enable_write_behind(CHAT_FLUSH_ROWS, CHAT_FLUSH_MS, CHAT_QUEUE_MAX, CHAT_SYNCHRONOUS)
+start_backfill()  # indexes chats saved before full-text search existed, once
 
 # ---- Session defaults --------------------------------------------------------
 if "logged_in" not in st.session_state: st.session_state.logged_in = False
 if "username"  not in st.session_state: st.session_state.username  = ""
 if "chat_history" not in st.session_state: st.session_state.chat_history = []
+if "history_more" not in st.session_state: st.session_state.history_more = False  # older turns in the DB
+if "pending_bodies" not in st.session_state: st.session_state.pending_bodies = {}  # local id -> (u, a, b)
+if "local_turn_id" not in st.session_state: st.session_state.local_turn_id = 0
 if "provider" not in st.session_state: st.session_state.provider = "Groq"
+if "stream" not in st.session_state: st.session_state.stream = True
+if "uploads" not in st.session_state: st.session_state.uploads = {}  # uploader file_id -> sha256
+if "search_page" not in st.session_state: st.session_state.search_page = (None, 0)  # (query, page)
+if not st.session_state.logged_in: resume_login()
 
 # ---- UI ----------------------------------------------------------------------
 st.set_page_config(page_title="AI Assistant Chatbot", page_icon="🤖", layout="centered")
@@ -153,6 +172,9 @@ if init_err:
     st.sidebar.error(init_err)
 else:
     st.sidebar.success(f"{st.session_state.provider} ready ✓ ({default_model})")
+    if not dispatcher.breakers[st.session_state.provider.lower()].allow():
+        st.sidebar.warning(f"{st.session_state.provider} is failing; requests go to the other provider for now.")
+st.session_state.stream = st.sidebar.checkbox("Stream responses", value=st.session_state.stream)
 
 st.sidebar.markdown("---")
 st.sidebar.header("User Panel")
@@ -161,9 +183,7 @@ st.sidebar.header("User Panel")
 if st.session_state.logged_in:
     st.sidebar.markdown(f"**Logged in as:** `{st.session_state.username}`")
     if st.sidebar.button("Logout"):
-        st.session_state.logged_in = False
-        st.session_state.username = ""
-        st.session_state.chat_history = []
+        log_out()
         st.rerun()
 else:
     st.sidebar.subheader("Register")
@@ -173,9 +193,7 @@ else:
         if not reg_user or not reg_pass:
             st.sidebar.warning("Enter both username and password.")
         elif insert_user(reg_user.strip(), reg_pass):
-            st.session_state.logged_in = True
-            st.session_state.username = reg_user.strip()
-            st.session_state.chat_history = load_chats_for_user(st.session_state.username)
+            log_in(reg_user.strip())
             st.sidebar.success("✅ Registered & logged in!")
             st.rerun()
         else:
@@ -187,9 +205,7 @@ else:
     log_pass = st.sidebar.text_input("Password", type="password", key="login_pass")
     if st.sidebar.button("Login"):
         if user_exists(log_user.strip(), log_pass):
-            st.session_state.logged_in = True
-            st.session_state.username = log_user.strip()
-            st.session_state.chat_history = load_chats_for_user(st.session_state.username)
+            log_in(log_user.strip())
             st.sidebar.success(f"Welcome, {st.session_state.username}! 👋")
             st.rerun()
         else:
@@ -200,29 +216,55 @@ st.title("🤖 Smart AI Chatbot")
 st.write("Ask anything — coding, study help, brainstorming, tasks. You can upload files too.")
 
 if st.session_state.logged_in:
+    # One trace per script run; each stage below is a timed span in it
+    trace = tracer.trace(provider=st.session_state.provider.lower(), model=default_model)
 
     uploaded_file = st.file_uploader("Attach file (optional)", type=["png", "jpg", "jpeg", "pdf", "txt", "md"])
-    attached_summary = ""
+    attachment = None
     if uploaded_file:
-        path = os.path.join("uploads", uploaded_file.name)
-        with open(path, "wb") as f: f.write(uploaded_file.getbuffer())
-
-        if uploaded_file.type.startswith("image/"):
-            img = Image.open(path)
-            w, h = img.size
-            st.image(img, caption=f"{uploaded_file.name} — {w}×{h}px", width=w)
-            attached_summary = f"[Image attached: {uploaded_file.name} ({w}×{h}px)]"
-
-        elif uploaded_file.name.lower().endswith((".txt", ".md")):
-            txt = uploaded_file.getvalue().decode("utf-8", errors="ignore")[:4000]
-            st.text_area("Extracted text (truncated):", value=txt, height=200)
-            attached_summary = f"[Document: {uploaded_file.name}]\n{txt}"
-        elif uploaded_file.name.lower().endswith(".pdf") and _HAS_PYPDF2:
-            with open(path, "rb") as f:
-                pdf = PyPDF2.PdfReader(f)
-                text = "".join(p.extract_text() or "" for p in pdf.pages)[:4000]
-                st.text_area("Extracted PDF (truncated):", value=text, height=200)
-                attached_summary = f"[PDF: {uploaded_file.name}]\n{text}"
+        # Stored once per upload (not per rerun) and once per content across users
+        attached_hash = st.session_state.uploads.get(uploaded_file.file_id)
+        if attached_hash is None:
+            with trace.span("upload_write"):
+                uploaded_file.seek(0)
+                attached_hash = store_blob(uploaded_file, st.session_state.username, uploaded_file.name,
+                                           uploaded_file.type)
+            st.session_state.uploads[uploaded_file.file_id] = attached_hash
+        data = uploaded_file.getvalue()
+
+        bar = st.empty()
+        try:
+            with trace.span("extract"):
+                extraction = extract_attachment(uploaded_file.name, uploaded_file.type, data, attached_hash,
+                                                budget=EXTRACT_BUDGET,
+                                                progress=lambda frac: bar.progress(frac, text="Extracting text…"))
+        except UnreadableFile:
+            # Not kept: drop this upload's ref so the blob can be collected
+            release_blobs(st.session_state.username, attached_hash)
+            del st.session_state.uploads[uploaded_file.file_id]
+            extraction = None
+            st.error(f"❌ Could not read {uploaded_file.name}; is the file damaged?")
+        bar.empty()
+        attachment = describe_attachment(uploaded_file.name, attached_hash, extraction)
+
+        if extraction and extraction.kind == "image":
+            w, h = extraction.meta["width"], extraction.meta["height"]
+            with trace.span("thumbnail"):
+                thumb, (tw, _) = thumbnail(attached_hash)
+            st.image(thumb, caption=f"{uploaded_file.name} — {w}×{h}px", width=tw)
+
+        elif extraction and extraction.kind == "text":
+            st.text_area("Extracted text (truncated):", value=extraction.text[:EXTRACT_MAX_CHARS], height=200)
+        elif extraction and extraction.kind == "pdf":
+            if not extraction.meta["complete"]:
+                st.warning("PDF extraction timed out; using the pages read so far while the rest is read "
+                           "in the background.")
+            st.text_area("Extracted PDF (truncated):", value=extraction.text[:EXTRACT_MAX_CHARS], height=200)
+
+        if attachment and len(attachment.text) > EXTRACT_MAX_CHARS and HAS_RETRIEVAL:
+            with st.spinner("Indexing document..."), trace.span("index"):
+                index = get_index(attached_hash, attachment.text)
+            st.caption(f"Indexed {len(index.chunks)} passages; the most relevant ones are sent with your question.")
 
     user_input = st.text_area("You:", height=120)
     if st.button("Send"):
@@ -231,40 +273,121 @@ if st.session_state.logged_in:
         elif init_err:
             st.error(init_err)
         else:
-            with st.spinner("Thinking..."):
-                content = user_input.strip() + ("\n\n" + attached_summary if attached_summary else "")
-                msgs = [
-                    {"role": "system", "content": "You are a helpful AI assistant."},
-                    {"role": "user", "content": content}
-                ]
-                try:
-                    answer = llm_chat(st.session_state.provider, client, default_model, msgs)
-                except Exception as e:
-                    st.error(f"⚠️ API error: {e}")
-                    answer = "Unable to reach AI service. Check API key/provider."
-
-                st.session_state.chat_history.append((user_input.strip(), attached_summary, answer))
-                save_chat_to_db(st.session_state.username, user_input.strip(), attached_summary, answer)
-
-    # Chat history + delete button
+            with trace.span("prompt_build"):
+                turn = prepare_turn(st.session_state.username, st.session_state.provider, user_input, attachment)
+            trace.set(prompt_tokens=turn.tokens - MAX_TOKENS, cache_hit=turn.cached is not None)
+            parts, err, done = [], None, False
+            try:
+                with trace.span("provider_call") as span:
+                    if turn.cached is not None:
+                        parts.append(turn.cached)
+                    elif st.session_state.stream:
+                        placeholder = st.empty()
+                        with st.spinner("Thinking..."):
+                            # The spinner only covers the wait for the first token
+                            # and any wait for a rate-limit slot
+                            deltas = scheduler.stream(turn.key, turn.username, turn.tokens, lambda:
+                                dispatcher.stream(st.session_state.provider, turn.msgs,
+                                                  max_tokens=MAX_TOKENS, temperature=TEMPERATURE))
+                            parts.append(next(deltas, ""))
+                        render_stream(deltas, placeholder, parts)
+                    else:
+                        with st.spinner("Thinking..."):
+                            parts.extend(scheduler.stream(turn.key, turn.username, turn.tokens, lambda: [
+                                dispatcher.chat(st.session_state.provider, turn.msgs,
+                                                max_tokens=MAX_TOKENS, temperature=TEMPERATURE)]))
+                    span.set(completion_tokens=estimate_tokens("".join(parts)))
+                done = True
+            except Exception as e:
+                err = e
+                st.error(f"⚠️ API error: {e}")
+            finally:
+                # Also runs when Streamlit stops the script mid-stream, so
+                # whatever already arrived is persisted instead of dropped.
+                with trace.span("db_commit"):
+                    answer, chat_id = finish_turn(turn, parts, done, err)
+                st.session_state.chat_history += keyed_turns([(chat_id, turn.user_text, turn.attached_summary, answer)])
+
+    # Full-text search over everything this user has saved
+    query = st.text_input("🔎 Search your chats", placeholder="e.g. invoice refund")
+    if query.strip():
+        page = st.session_state.search_page[1] if st.session_state.search_page[0] == query else 0
+        with trace.span("search"):
+            results, more = search_chats(st.session_state.username, query, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+        if not results:
+            st.caption("No matching messages.")
+        for _, created_at, u, a, b in results:
+            st.markdown(f"**You:** {u}" + (f"  \n_Attachment:_ {a}" if a else "") + f"  \n**AI:** {b}")
+            st.caption(created_at)
+        prev_col, next_col = st.columns(2)
+        if page > 0 and prev_col.button("← Newer results"):
+            st.session_state.search_page = (query, page - 1)
+            st.rerun()
+        if more and next_col.button("Older results →"):
+            st.session_state.search_page = (query, page + 1)
+            st.rerun()
+
+    # Chat history + delete button. Only the newest HISTORY_VISIBLE turns are
+    # rendered by default, so a rerun costs the same however long history is.
+    settle_pending()
     if st.session_state.chat_history:
         st.markdown("### 💬 Chat History")
-        for u, a, b in st.session_state.chat_history:
-            st.markdown(f"**You:** {u}")
-            if a:
-                st.markdown(f"_Attachment:_ {a}")
-            st.markdown(f"**AI:** {b}")
-            st.write("---")
+        with trace.span("render"):
+            history = st.session_state.chat_history
+            older, recent = history[:-HISTORY_VISIBLE], history[-HISTORY_VISIBLE:]
+            if older or st.session_state.history_more:
+                label = f"Show {len(older)} earlier turns" if older else "Show earlier turns"
+                if st.toggle(label, key="show_older"):
+                    if st.session_state.history_more and st.button("⬆️ Load older"):
+                        ids = [t[0] for t in history if t[0] > 0]
+                        if ids:
+                            load_history(before_id=min(ids))
+                        else:
+                            st.session_state.history_more = False
+                        st.rerun()
+                    # Previews only; a turn's body is read when it is opened
+                    for t in older:
+                        if st.toggle(f"**You:** {t[1]}", key=f"open_turn_{t[0]}"):
+                            st.markdown(turn_markdown(t))
+            for t in recent:
+                st.markdown(turn_markdown(t))
 
         if st.button("🗑️ Delete Chat History", key="delete_chat", type="primary"):
             delete_user_chats(st.session_state.username)
             st.session_state.chat_history = []
+            st.session_state.history_more = False
+            st.session_state.pending_bodies = {}
+            st.session_state.uploads = {}  # their refs went with the history; store again on next Send
             st.success("✅ Chat history deleted!")
             st.rerun()
 
 else:
     st.info("Please login or register to start chatting.")
 
+# Rendered last so the counters include this run's Send
+with st.sidebar.expander("Response cache"):
+    stats = response_cache.stats
+    hits = stats["memory_hits"] + stats["disk_hits"]
+    lookups = hits + stats["misses"]
+    st.caption(f"Hit rate: {hits / lookups:.0%}" if lookups else "Hit rate: –")
+    st.caption(f"Hits: {stats['memory_hits']} memory / {stats['disk_hits']} disk · "
+               f"Misses: {stats['misses']} · Skipped: {stats['skipped']} · Evictions: {stats['evictions']}")
+
+with st.sidebar.expander("Request queue"):
+    stats = scheduler.stats()
+    st.caption(f"Queued: {stats['queue_depth']} ({stats['waiting_users']} users) · In flight: {stats['in_flight']} · "
+               f"Coalesced: {stats['coalesced'] + stats['coalesced_remote']}")
+    st.caption(f"Wait p50: {stats['wait_p50']:.2f}s · p95: {stats['wait_p95']:.2f}s")
+
+if st.session_state.logged_in and st.session_state.username in ADMIN_USERS:
+    with st.sidebar.expander("Latency by stage (last hour)"):
+        stages = tracer.stage_latencies()
+        if stages:
+            st.table([{"stage": name, "n": s["count"], "p50 ms": f"{s['p50']:.1f}", "p95 ms": f"{s['p95']:.1f}",
+                       "p99 ms": f"{s['p99']:.1f}", "cache hits": s["cache_hits"]} for name, s in stages.items()])
+        else:
+            st.caption("No requests traced yet.")
+
 st.markdown("<hr>", unsafe_allow_html=True)
 st.caption("🤖 AI Chatbot © 2025 | OpenAI & Groq compatible")
 
@@ -6,3 +6,116 @@ GROQ_API_KEY   =  "Your groq API" # if you use GroqAI
 if not GROQ_API_KEY and not OPENAI_API_KEY:
     raise ValueError("Set GROQ_API_KEY (or OPENAI_API_KEY).")
 
+# Provider HTTP client settings (shared by every session in the process)
+PROVIDER_TIMEOUT         = float(os.getenv("PROVIDER_TIMEOUT", "60"))        # seconds, whole request
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "5")) # seconds, TCP/TLS connect
+PROVIDER_MAX_CONNECTIONS = int(os.getenv("PROVIDER_MAX_CONNECTIONS", "50"))
+PROVIDER_MAX_KEEPALIVE   = int(os.getenv("PROVIDER_MAX_KEEPALIVE", "20"))
+
+# Write-behind chat logging: queue rows and group-commit them off the request path
+CHAT_WRITE_BEHIND  = os.getenv("CHAT_WRITE_BEHIND", "0") == "1"
+CHAT_FLUSH_ROWS    = int(os.getenv("CHAT_FLUSH_ROWS", "64"))       # flush after this many rows
+CHAT_FLUSH_MS      = int(os.getenv("CHAT_FLUSH_MS", "200"))        # ...or after this many ms
+CHAT_QUEUE_MAX     = int(os.getenv("CHAT_QUEUE_MAX", "10000"))     # producers block beyond this
+CHAT_SYNCHRONOUS   = os.getenv("CHAT_SYNCHRONOUS", "NORMAL")       # OFF / NORMAL / FULL
+
+# LLM response cache (in-memory LRU + SQLite tier). Answers sampled with
+# temperature > 0 are only cached when RESPONSE_CACHE_ANY_TEMPERATURE=1.
+RESPONSE_CACHE                 = os.getenv("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_ANY_TEMPERATURE = os.getenv("RESPONSE_CACHE_ANY_TEMPERATURE", "0") == "1"
+RESPONSE_CACHE_MEMORY_ITEMS    = int(os.getenv("RESPONSE_CACHE_MEMORY_ITEMS", "256"))
+RESPONSE_CACHE_TTL             = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))    # seconds
+RESPONSE_CACHE_DB_MAX_BYTES    = int(os.getenv("RESPONSE_CACHE_DB_MAX_BYTES", str(64 << 20)))
+
+# Attachment extraction
+EXTRACT_MAX_CHARS      = int(os.getenv("EXTRACT_MAX_CHARS", "4000"))      # stop parsing past this
+EXTRACT_TIMEOUT        = float(os.getenv("EXTRACT_TIMEOUT", "30"))        # seconds per document
+EXTRACT_POOL_MIN_PAGES = int(os.getenv("EXTRACT_POOL_MIN_PAGES", "40"))   # PDFs this long use worker processes
+EXTRACT_POOL_WORKERS   = int(os.getenv("EXTRACT_POOL_WORKERS", "2"))
+
+# Retrieval over attachments: long documents are indexed (BM25) and only the
+# chunks relevant to the question go into the prompt
+RETRIEVAL_MAX_CHARS     = int(os.getenv("RETRIEVAL_MAX_CHARS", "500000"))  # extraction budget when indexing
+RETRIEVAL_CHUNK_CHARS   = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "800"))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "100"))
+RETRIEVAL_TOP_K         = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_DIR           = os.getenv("RETRIEVAL_DIR", "indexes")
+
+# Multi-turn context: newest turns packed into a token budget, older ones
+# folded into a rolling summary
+CONTEXT_TOKEN_BUDGET        = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))   # estimated prompt tokens
+CONTEXT_MAX_TURNS           = int(os.getenv("CONTEXT_MAX_TURNS", "50"))        # turns considered per request
+CONTEXT_SUMMARY_MIN_TURNS   = int(os.getenv("CONTEXT_SUMMARY_MIN_TURNS", "4")) # turns evicted per summary update
+CONTEXT_SUMMARY_MAX_TOKENS  = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "200"))
+
+# Provider resilience: per-provider deadline (seconds, covers retries), jittered
+# retries, circuit breaker, and optional hedging to the other provider
+PROVIDER_DEADLINES  = {"groq":   float(os.getenv("GROQ_DEADLINE", "20")),
+                       "openai": float(os.getenv("OPENAI_DEADLINE", "40"))}
+PROVIDER_RETRIES    = int(os.getenv("PROVIDER_RETRIES", "2"))
+BREAKER_FAILURES    = int(os.getenv("BREAKER_FAILURES", "5"))      # consecutive failures to open
+BREAKER_COOLDOWN    = float(os.getenv("BREAKER_COOLDOWN", "30"))   # seconds before probing again
+HEDGE_REQUESTS      = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "2.0"))  # until enough samples for a p95
+HEDGE_MIN_DELAY     = float(os.getenv("HEDGE_MIN_DELAY", "0.25"))
+
+# Headless HTTP API (api.py). Raise PROVIDER_MAX_CONNECTIONS to match the
+# number of concurrent in-flight LLM calls you expect.
+API_MAX_BODY    = int(os.getenv("API_MAX_BODY", str(25 << 20)))       # bytes, uploads included
+API_SESSION_TTL = int(os.getenv("API_SESSION_TTL", str(24 * 3600)))   # seconds
+
+
+# Admission control in front of the providers (scheduler.py): token buckets
+# per user and for the whole process, refilled continuously over a minute.
+# Requests over the limit queue (fairly across users) instead of failing.
+RATE_USER_RPM      = int(os.getenv("RATE_USER_RPM", "20"))          # requests/min per user
+RATE_USER_TPM      = int(os.getenv("RATE_USER_TPM", "20000"))       # estimated tokens/min per user
+RATE_GLOBAL_RPM    = int(os.getenv("RATE_GLOBAL_RPM", "60"))
+RATE_GLOBAL_TPM    = int(os.getenv("RATE_GLOBAL_TPM", "60000"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "120"))  # seconds queued before giving up
+
+# Per-request stage timings (metrics.py): spans are buffered in memory and
+# written to the metrics table in batches. ADMIN_USERS (comma-separated) see
+# the latency panel in the sidebar.
+METRICS                = os.getenv("METRICS", "1") == "1"
+METRICS_FLUSH_MS       = int(os.getenv("METRICS_FLUSH_MS", "1000"))
+METRICS_RETENTION_DAYS = float(os.getenv("METRICS_RETENTION_DAYS", "7"))
+ADMIN_USERS            = {u.strip() for u in os.getenv("ADMIN_USERS", "").split(",") if u.strip()}
+
+# Uploads: content-addressed blob store with cached image previews (blobs.py)
+BLOB_DIR         = os.getenv("BLOB_DIR", "blobs")
+BLOB_CHUNK_BYTES = int(os.getenv("BLOB_CHUNK_BYTES", str(1 << 20)))   # streamed write size
+THUMB_MAX_PX     = int(os.getenv("THUMB_MAX_PX", "512"))               # longest side of image previews
+
+# Full-text chat search (search.py)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+
+# Chat history rendering: turns fetched per "load older" page, and how many of
+# the newest stay expanded (older ones sit behind a toggle)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_VISIBLE   = int(os.getenv("HISTORY_VISIBLE", "10"))
+
+# Chat storage (storage.py / retention.py): columns of COMPRESS_MIN_BYTES or
+# more are stored zlib-compressed. Turns older than RETENTION_DAYS move to
+# ARCHIVE_DB when retention.py runs (0 keeps everything). The session keeps
+# only a HISTORY_PREVIEW_CHARS preview of each turn; bodies load on demand.
+COMPRESS_MIN_BYTES    = int(os.getenv("COMPRESS_MIN_BYTES", "512"))
+RETENTION_DAYS        = float(os.getenv("RETENTION_DAYS", "0"))
+ARCHIVE_DB            = os.getenv("ARCHIVE_DB", "archive.db")
+HISTORY_PREVIEW_CHARS = int(os.getenv("HISTORY_PREVIEW_CHARS", "80"))
+HISTORY_BODY_CACHE    = int(os.getenv("HISTORY_BODY_CACHE", "64"))    # full turns cached per process
+
+# Offline batch runs (batch.py): worker threads, and per-provider limits in
+# requests and estimated tokens per minute, separate from the UI's limits
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+BATCH_LIMITS  = {
+    "openai": (int(os.getenv("BATCH_OPENAI_RPM", "500")), int(os.getenv("BATCH_OPENAI_TPM", "200000"))),
+    "groq":   (int(os.getenv("BATCH_GROQ_RPM", "30")),    int(os.getenv("BATCH_GROQ_TPM", "6000"))),
+}
+
+# Several worker processes on one host (shared.py): empty keeps sessions,
+# rate-limit buckets and in-flight call claims inside each process; a path
+# shares them through one SQLite file, ideally on tmpfs
+# (e.g. /dev/shm/chatbot-state.db)
+SHARED_STATE_DB    = os.getenv("SHARED_STATE_DB", "")
+SHARED_RESULT_TTL  = float(os.getenv("SHARED_RESULT_TTL", "60"))   # seconds a finished answer waits for followers
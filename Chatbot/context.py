@@ -0,0 +1,107 @@
+# context.py
+
+import logging
+import threading
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_TURNS, CONTEXT_SUMMARY_MIN_TURNS, CONTEXT_SUMMARY_MAX_TOKENS
+from storage import load_chat_page, load_summary, save_summary
+
+log = logging.getLogger(__name__)
+
+PER_MESSAGE_TOKENS = 4  # role/formatting overhead the providers add per message
+
+def estimate_tokens(text):
+    # ~4 chars per token for English prose; the word count floor keeps short,
+    # space-separated text from being underestimated. No tokenizer needed.
+    if not text:
+        return 0
+    return max(len(text) // 4, len(text.split())) + PER_MESSAGE_TOKENS
+
+# ---- Prompt assembly ---------------------------------------------------------
+def build_messages(username, system_prompt, user_content, budget=CONTEXT_TOKEN_BUDGET,
+                   evict_batch=CONTEXT_SUMMARY_MIN_TURNS, history=True):
+    """Pack the newest turns that fit in `budget` tokens around the new message.
+
+    Returns (messages, stale) where `stale` lists saved turns that were left out
+    of the window and are not yet covered by the rolling summary. The window
+    gives up turns `evict_batch` at a time, and every turn it gives up is in
+    `stale` for the summary update, so no turn is in neither. With
+    `history=False` the message stands alone: no summary and no turns.
+    """
+    summary, upto_id = load_summary(username) if history else ("", 0)
+    turns = load_chat_page(username, CONTEXT_MAX_TURNS) if history else []
+
+    used = estimate_tokens(system_prompt) + estimate_tokens(user_content) + estimate_tokens(summary)
+    packed = 0
+    for _, u, _, b in reversed(turns):
+        cost = estimate_tokens(u) + estimate_tokens(b)
+        if used + cost > budget:
+            break
+        used += cost
+        packed += 1
+    stale = [t for t in turns[:len(turns) - packed] if t[0] is not None and t[0] > upto_id]
+    if stale and len(stale) < evict_batch:
+        # Evict a few more of the oldest window turns along with them, so the
+        # next several turns fit without another summary call
+        for chat_id, u, _, b in turns[len(turns) - packed:][:min(evict_batch - len(stale), packed - 1)]:
+            if chat_id is None:
+                break  # not saved yet, so it could not be summarized
+            used -= estimate_tokens(u) + estimate_tokens(b)
+            packed -= 1
+    window = turns[len(turns) - packed:]
+    stale = [t for t in turns[:len(turns) - packed] if t[0] is not None and t[0] > upto_id]
+
+    msgs = [{"role": "system", "content": system_prompt}]
+    if summary:
+        msgs.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    for _, u, _, b in window:
+        msgs.append({"role": "user", "content": u})
+        msgs.append({"role": "assistant", "content": b})
+    msgs.append({"role": "user", "content": user_content})
+
+    full = sum(estimate_tokens(u) + estimate_tokens(b) for _, u, _, b in turns)
+    log.info("prompt user=%s tokens=%d turns=%d/%d summary=%s (full history would be ~%d)",
+             username, used, packed, len(turns), bool(summary),
+             estimate_tokens(system_prompt) + estimate_tokens(user_content) + full)
+    return msgs, stale
+
+# ---- Rolling summary ---------------------------------------------------------
+_updating = set()
+_updating_lock = threading.Lock()
+
+def llm_summarizer(chat, max_tokens=CONTEXT_SUMMARY_MAX_TOKENS):
+    # `chat(messages, max_tokens=..., temperature=...)` -> str, e.g. a partial of llm_chat
+    def summarize(previous, turns):
+        transcript = "\n".join(f"User: {u}\nAssistant: {b}" for _, u, _, b in turns)
+        msgs = [
+            {"role": "system", "content": "Update the running summary of a conversation. Keep facts, names, "
+                                          "decisions and open questions. Reply with the summary only."},
+            {"role": "user", "content": f"Current summary:\n{previous or '(none)'}\n\nNew turns:\n{transcript}"},
+        ]
+        return chat(msgs, max_tokens=max_tokens, temperature=0)
+    return summarize
+
+def refresh_summary(username, stale, summarize):
+    # Folds only the newly evicted turns into the stored summary, in a
+    # background thread so the user's answer is never delayed by it.
+    if not stale:
+        return None
+    with _updating_lock:
+        if username in _updating:
+            return None
+        _updating.add(username)
+
+    def run():
+        try:
+            previous, upto_id = load_summary(username)
+            turns = [t for t in stale if t[0] > upto_id]
+            if turns:
+                save_summary(username, summarize(previous, turns).strip(), turns[-1][0])
+        except Exception:
+            log.exception("summary update failed for %s", username)
+        finally:
+            with _updating_lock:
+                _updating.discard(username)
+
+    thread = threading.Thread(target=run, name="summary-update", daemon=True)
+    thread.start()
+    return thread
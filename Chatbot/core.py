@@ -0,0 +1,92 @@
+# core.py
+
+# One chat turn, independent of the front end: chatbot.py (Streamlit) and
+# api.py (asyncio HTTP) both go prepare_turn -> provider call -> finish_turn.
+
+from collections import namedtuple
+from functools import partial
+from cache import response_cache, cache_key
+from config import EXTRACT_MAX_CHARS, RETRIEVAL_MAX_CHARS
+from context import build_messages, estimate_tokens, llm_summarizer, refresh_summary
+from providers import DEFAULT_MODELS, dispatcher
+from retrieval import HAS_RETRIEVAL, relevant_context
+from scheduler import scheduler
+from storage import save_chat_to_db
+
+# ---- Generation settings -----------------------------------------------------
+MAX_TOKENS = 300
+TEMPERATURE = 0.7
+SYSTEM_PROMPT = "You are a helpful AI assistant."
+FALLBACK_ANSWER = "Unable to reach AI service. Check API key/provider."
+
+# Extract whole documents when they can be indexed, else only what gets sent
+EXTRACT_BUDGET = RETRIEVAL_MAX_CHARS if HAS_RETRIEVAL else EXTRACT_MAX_CHARS
+
+# label: the "[PDF: name]" header; text: extracted body ("" for images)
+Attachment = namedtuple("Attachment", "sha256 label text")
+# tokens: estimated prompt + completion tokens, charged against the rate limits
+# attached_summary is what gets saved with the turn; document is the SHA-256 its
+# text is stored under (once per document), None without document text
+Turn = namedtuple("Turn", "username provider user_text attached_summary document msgs key stale cached tokens")
+
+# ---- Attachments -------------------------------------------------------------
+def describe_attachment(filename, sha256, extraction):
+    if extraction is None:
+        return None
+    if extraction.kind == "image":
+        w, h = extraction.meta["width"], extraction.meta["height"]
+        return Attachment(sha256, f"[Image attached: {filename} ({w}×{h}px)]", "")
+    if extraction.kind == "pdf":
+        return Attachment(sha256, f"[PDF: {filename}]", extraction.text)
+    return Attachment(sha256, f"[Document: {filename}]", extraction.text)
+
+# ---- Turns -------------------------------------------------------------------
+def prepare_turn(username, provider, user_text, attachment=None, history=True):
+    # Builds the prompt (relevant attachment passages + packed history) and
+    # looks it up in the response cache; Turn.cached is the answer on a hit.
+    user_text = user_text.strip()
+    attached, attached_summary, document = "", "", None
+    if attachment:
+        attached = attached_summary = attachment.label
+        if attachment.text:
+            # Only the passages relevant to this question, not the whole document
+            attached += "\n" + relevant_context(attachment.sha256, attachment.text, user_text)
+            # Saved: the opening of the document, the same for every turn about it
+            attached_summary += "\n" + attachment.text[:EXTRACT_MAX_CHARS]
+            document = attachment.sha256
+    content = user_text + ("\n\n" + attached if attached else "")
+    msgs, stale = build_messages(username, SYSTEM_PROMPT, content, history=history)
+
+    model = DEFAULT_MODELS["openai" if provider.lower() == "openai" else "groq"]
+    key = cache_key(provider, model, msgs, TEMPERATURE, MAX_TOKENS, attachment.sha256 if attachment else "")
+    cached = None
+    if response_cache.cacheable(TEMPERATURE):
+        cached = response_cache.get(key)
+    else:
+        response_cache.skip()
+    tokens = sum(estimate_tokens(m["content"]) for m in msgs) + MAX_TOKENS
+    return Turn(username, provider, user_text, attached_summary, document, msgs, key, stale, cached, tokens)
+
+def finish_turn(turn, parts, done, err=None, limiter=scheduler):
+    # Persists whatever arrived: a complete answer is cached and saved, a
+    # partial one is saved with an interrupted/cancelled marker. Returns
+    # (answer, chat id), the id None while the row waits in write-behind.
+    # The summary update's call is charged to the user's buckets in `limiter`.
+    answer = "".join(parts).strip()
+    if answer and not done:
+        answer += " …[interrupted]" if err else " …[cancelled]"
+    if done and turn.cached is None and answer and response_cache.cacheable(TEMPERATURE):
+        response_cache.put(turn.key, answer)
+    if not answer:
+        answer = FALLBACK_ANSWER
+    chat_id = save_chat_to_db(turn.username, turn.user_text, turn.attached_summary, answer, turn.document)
+    if turn.stale and done:
+        chat = partial(limited_chat, limiter, turn.username, turn.provider)
+        refresh_summary(turn.username, turn.stale, llm_summarizer(chat))
+    return answer, chat_id
+
+def limited_chat(limiter, username, provider, messages, **kwargs):
+    # A provider call outside a turn (e.g. a summary update), admitted like one
+    tokens = sum(estimate_tokens(m["content"]) for m in messages) + kwargs.get("max_tokens", MAX_TOKENS)
+    limiter.acquire(username, tokens)
+    return dispatcher.chat(provider, messages, **kwargs)
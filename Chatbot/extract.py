@@ -0,0 +1,239 @@
+# extract.py
+
+import importlib.util
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, TimeoutError, as_completed
+from config import EXTRACT_MAX_CHARS, EXTRACT_TIMEOUT, EXTRACT_POOL_MIN_PAGES, EXTRACT_POOL_WORKERS
+from storage import get_conn, inflate, pack
+
+log = logging.getLogger(__name__)
+
+# kind: "text" / "pdf" / "image"; meta: small JSON-able dict (pages, size, ...)
+Extraction = namedtuple("Extraction", "kind text meta")
+
+class UnreadableFile(ValueError):
+    """The extractor for the file's type could not parse it (corrupt or mislabelled)."""
+
+# ---- Extractors --------------------------------------------------------------
+class Extractor:
+    kind = None
+    extensions = ()
+
+    def available(self):
+        return True
+
+    def matches(self, filename, mime):
+        return filename.lower().endswith(self.extensions)
+
+    def extract(self, data, budget, progress=None, timeout=EXTRACT_TIMEOUT):
+        # timeout: seconds before returning what was read so far (None: no limit)
+        raise NotImplementedError
+
+class TextExtractor(Extractor):
+    kind = "text"
+    extensions = (".txt",)
+
+    def extract(self, data, budget, progress=None, timeout=EXTRACT_TIMEOUT):
+        # utf-8 is at most 4 bytes per char, so never decode more than needed
+        return Extraction(self.kind, data[:budget * 4].decode("utf-8", errors="ignore")[:budget], {})
+
+class MarkdownExtractor(TextExtractor):
+    extensions = (".md",)
+
+class ImageExtractor(Extractor):
+    kind = "image"
+    extensions = (".png", ".jpg", ".jpeg")
+
+    def matches(self, filename, mime):
+        return (mime or "").startswith("image/") or super().matches(filename, mime)
+
+    def extract(self, data, budget, progress=None, timeout=EXTRACT_TIMEOUT):
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as img:  # reads the header only
+            w, h = img.size
+        return Extraction(self.kind, "", {"width": w, "height": h})
+
+class PdfExtractor(Extractor):
+    kind = "pdf"
+    extensions = (".pdf",)
+
+    def available(self):
+        return importlib.util.find_spec("PyPDF2") is not None
+
+    def extract(self, data, budget, progress=None, timeout=EXTRACT_TIMEOUT):
+        import PyPDF2
+        reader = PyPDF2.PdfReader(io.BytesIO(data))
+        pages = len(reader.pages)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if pages < EXTRACT_POOL_MIN_PAGES:
+            text, done = _pdf_pages(reader, 0, pages, budget, deadline, progress)
+            return Extraction(self.kind, text[:budget], {"pages": pages, "complete": done})
+
+        # Text-heavy PDFs usually fill the budget within the first pages, so
+        # only hand the rest to worker processes when they do not.
+        text, done = _pdf_pages(reader, 0, POOL_CHUNK_PAGES, budget, deadline)
+        if done and len(text) < budget:
+            try:
+                rest, done = _pdf_pooled(data, POOL_CHUNK_PAGES, pages, budget - len(text), deadline, progress)
+                text += rest
+            except BrokenExecutor:
+                _reset_pool()  # fall back to parsing in-process
+                rest, done = _pdf_pages(reader, POOL_CHUNK_PAGES, pages, budget - len(text), deadline, progress)
+                text += rest
+        return Extraction(self.kind, text[:budget], {"pages": pages, "complete": done})
+
+EXTRACTORS = [TextExtractor(), MarkdownExtractor(), PdfExtractor(), ImageExtractor()]
+
+def find_extractor(filename, mime=None):
+    for ex in EXTRACTORS:
+        if ex.matches(filename, mime) and ex.available():
+            return ex
+    return None
+
+# ---- PDF page walking --------------------------------------------------------
+def _pdf_pages(reader, start, stop, budget, deadline=None, progress=None):
+    # Stops at the character budget or deadline instead of parsing every page.
+    # Returns (text, finished) where finished is False if the deadline hit first.
+    out, n = [], 0
+    for i in range(start, stop):
+        if deadline is not None and time.monotonic() > deadline:
+            return "".join(out), False
+        t = reader.pages[i].extract_text() or ""
+        out.append(t)
+        n += len(t)
+        if progress:
+            progress((i - start + 1) / (stop - start))
+        if n >= budget:
+            break
+    return "".join(out), True
+
+def _pdf_range(path, start, stop, budget):
+    import PyPDF2
+    return _pdf_pages(PyPDF2.PdfReader(path), start, stop, budget)[0]
+
+POOL_CHUNK_PAGES = 16
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            import multiprocessing
+            # spawn: forking a threaded Streamlit server is not safe
+            _pool = ProcessPoolExecutor(EXTRACT_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def _pdf_pooled(data, start, pages, budget, deadline, progress):
+    # Page ranges are parsed in worker processes; results are joined in page
+    # order and the remaining ranges are cancelled once the budget is covered.
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(data)
+    try:
+        futures = {_get_pool().submit(_pdf_range, f.name, s, min(s + POOL_CHUNK_PAGES, pages), budget):
+                   (s - start) // POOL_CHUNK_PAGES
+                   for s in range(start, pages, POOL_CHUNK_PAGES)}
+        parts = [None] * len(futures)
+        finished, done = 0, True
+        try:
+            wait = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            for fut in as_completed(futures, timeout=wait):
+                parts[futures[fut]] = fut.result()
+                finished += 1
+                if progress:
+                    progress(finished / len(parts))
+                if sum(len(p) for p in _prefix(parts)) >= budget:
+                    break
+        except TimeoutError:
+            done = False
+        finally:
+            for fut in futures:
+                fut.cancel()
+        return "".join(_prefix(parts)), done
+    finally:
+        os.unlink(f.name)
+
+def _prefix(parts):
+    # Contiguous leading chunks only, so the text never skips pages
+    for p in parts:
+        if p is None:
+            return
+        yield p
+
+# ---- Cached entry point ------------------------------------------------------
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+MEMO_ITEMS = 64
+_partial = {}   # key -> timed-out result, served while _finish() keeps reading
+
+def extract_attachment(filename, mime, data, sha256, budget=EXTRACT_MAX_CHARS, progress=None):
+    # Keyed by the SHA-256 of the bytes, so reruns and re-uploads (under any
+    # name) skip parsing. Returns None when no extractor handles the file.
+    ex = find_extractor(filename, mime)
+    if ex is None:
+        return None
+    key = (sha256, ex.kind, budget)
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+        if key in _partial:
+            return _partial[key]
+
+    with get_conn() as conn:
+        row = conn.execute("SELECT text, meta FROM extractions WHERE sha256=? AND kind=? AND budget=?", key).fetchone()
+    if row:
+        result = Extraction(ex.kind, inflate(row[0]), json.loads(row[1]))
+        _remember(key, result, store=False)
+        return result
+
+    try:
+        result = ex.extract(data, budget, progress)
+    except Exception as e:
+        raise UnreadableFile(f"unreadable {ex.kind} file {filename}: {e}") from e
+    if not result.meta.get("complete", True):
+        # Reruns get this partial text at once while the whole file is read
+        # once more in the background, without a deadline
+        with _memo_lock:
+            if key in _partial or key in _memo:
+                return result
+            _partial[key] = result
+        threading.Thread(target=_finish, args=(ex, key, data), name="extract-finish", daemon=True).start()
+        return result
+    _remember(key, result)
+    return result
+
+def _finish(ex, key, data):
+    # On failure the partial result stays in _partial, so reruns keep using
+    # it rather than timing out again
+    try:
+        _remember(key, ex.extract(data, key[2], timeout=None))
+    except Exception:
+        log.exception("background extraction of %s failed", key[0])
+        return
+    with _memo_lock:
+        _partial.pop(key, None)
+
+def _remember(key, result, store=True):
+    if store:
+        with get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO extractions (sha256, kind, budget, text, meta) VALUES (?, ?, ?, ?, ?)",
+                         key + (pack(result.text), json.dumps(result.meta)))
+    with _memo_lock:
+        _memo[key] = result
+        while len(_memo) > MEMO_ITEMS:
+            _memo.popitem(last=False)
@@ -0,0 +1,163 @@
+# metrics.py
+
+import atexit
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from config import METRICS, METRICS_FLUSH_MS, METRICS_RETENTION_DAYS
+from stats import percentile
+from storage import get_conn
+
+log = logging.getLogger(__name__)
+
+# Request stages, in the order they happen during a Send
+STAGES = ("upload_write", "extract", "thumbnail", "index", "prompt_build", "provider_call", "db_commit", "search", "render")
+
+_trace_ids = itertools.count(1)
+
+# ---- Spans -------------------------------------------------------------------
+class Span:
+    """Times one stage; attributes set on it override the trace's."""
+
+    __slots__ = ("trace", "stage", "attrs", "start")
+
+    def __init__(self, trace, stage, attrs):
+        self.trace, self.stage, self.attrs = trace, stage, attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.tracer.record(self.trace, self.stage, time.perf_counter() - self.start, self.attrs,
+                                 exc_type is not None)
+        return False
+
+class Trace:
+    """One request. Attributes (provider, model, token counts, cache_hit) are
+    shared by every span opened after they are set."""
+
+    __slots__ = ("tracer", "id", "attrs")
+
+    def __init__(self, tracer, attrs):
+        self.tracer = tracer
+        self.id = f"{os.getpid():x}-{next(_trace_ids):x}"
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def span(self, stage, **attrs):
+        return Span(self, stage, attrs)
+
+# ---- Collector ---------------------------------------------------------------
+class Tracer:
+    """Buffers finished spans and writes them to the metrics table in batches.
+
+    Recording a span is a tuple build and a deque append (a few microseconds);
+    SQLite is only touched by the background flusher.
+    """
+
+    def __init__(self, enabled=True, flush_ms=1000, retention_days=7):
+        self.enabled = enabled
+        self.interval = flush_ms / 1000
+        self.retention = retention_days * 86400
+        self._buffer = deque()   # append/popleft are atomic, so no lock on the hot path
+        self._thread = None
+        self._lock = threading.Lock()
+        self._totals = {}        # stage -> [count, seconds], this process since start
+        self._pruned = 0.0
+
+    def trace(self, **attrs):
+        return Trace(self, attrs)
+
+    def record(self, trace, stage, seconds, attrs, error=False):
+        if not self.enabled:
+            return
+        a = {**trace.attrs, **attrs} if attrs else trace.attrs
+        cache_hit = a.get("cache_hit")
+        self._buffer.append((time.time(), trace.id, stage, seconds * 1000, a.get("provider"), a.get("model"),
+                             a.get("prompt_tokens"), a.get("completion_tokens"),
+                             None if cache_hit is None else int(cache_hit), int(error)))
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("metrics flush failed")
+
+    def flush(self):
+        rows = []
+        while self._buffer:
+            rows.append(self._buffer.popleft())
+        now = time.time()
+        prune = now - self._pruned > 3600
+        if not rows and not prune:
+            return
+        with self._lock:
+            for row in rows:
+                totals = self._totals.setdefault(row[2], [0, 0.0])
+                totals[0] += 1
+                totals[1] += row[3] / 1000
+        with get_conn() as conn:
+            conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if prune:
+                conn.execute("DELETE FROM metrics WHERE ts < ?", (now - self.retention,))
+                self._pruned = now
+
+    # ---- reading ----
+    def stage_latencies(self, window=3600):
+        """{stage: {"count", "p50", "p95", "p99", "cache_hits"}} in ms over the
+        last `window` seconds, from every process sharing the database."""
+        self.flush()
+        with get_conn() as conn:
+            rows = conn.execute("SELECT stage, duration_ms, cache_hit FROM metrics WHERE ts >= ? "
+                                "ORDER BY stage, duration_ms", (time.time() - window,)).fetchall()
+        by_stage = {}
+        for stage, ms, hit in rows:
+            by_stage.setdefault(stage, ([], []))[0].append(ms)
+            by_stage[stage][1].append(hit)
+        order = {s: i for i, s in enumerate(STAGES)}
+        out = {}
+        for stage in sorted(by_stage, key=lambda s: (order.get(s, len(order)), s)):
+            values, hits = by_stage[stage]
+            out[stage] = {"count": len(values), "p50": percentile(values, 0.50), "p95": percentile(values, 0.95),
+                          "p99": percentile(values, 0.99), "cache_hits": sum(h or 0 for h in hits)}
+        return out
+
+    def prometheus_text(self, window=300):
+        # Summary per stage: quantiles over the last `window` seconds, count and
+        # sum since this process started.
+        stages = self.stage_latencies(window)
+        with self._lock:
+            totals = {k: list(v) for k, v in self._totals.items()}
+        lines = ["# HELP chatbot_stage_seconds Time spent per request stage.",
+                 "# TYPE chatbot_stage_seconds summary"]
+        for stage in sorted(set(stages) | set(totals)):
+            for q in ("p50", "p95", "p99"):
+                if stage in stages:
+                    lines.append(f'chatbot_stage_seconds{{stage="{stage}",quantile="0.{q[1:]}"}} '
+                                 f'{stages[stage][q] / 1000:.6f}')
+            count, total = totals.get(stage, (0, 0.0))
+            lines.append(f'chatbot_stage_seconds_count{{stage="{stage}"}} {count}')
+            lines.append(f'chatbot_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        return "\n".join(lines) + "\n"
+
+tracer = Tracer(METRICS, METRICS_FLUSH_MS, METRICS_RETENTION_DAYS)
@@ -0,0 +1,405 @@
+# providers.py
+
+import asyncio
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from config import (OPENAI_API_KEY, GROQ_API_KEY, PROVIDER_TIMEOUT, PROVIDER_CONNECT_TIMEOUT,
+                    PROVIDER_MAX_CONNECTIONS, PROVIDER_MAX_KEEPALIVE, PROVIDER_DEADLINES, PROVIDER_RETRIES,
+                    BREAKER_FAILURES, BREAKER_COOLDOWN, HEDGE_REQUESTS, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY)
+from stats import percentile
+
+# Streamlit re-executes chatbot.py on every interaction, but imported modules
+# stay in sys.modules, so this registry lives for the whole process: one client
+# (and one keep-alive connection pool) per provider, shared by all sessions.
+DEFAULT_MODELS = {"openai": "gpt-3.5-turbo", "groq": "llama-3.1-8b-instant"}
+
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+# ---- Client registry ---------------------------------------------------------
+def _http_client(asynchronous=False):
+    import httpx
+    cls = httpx.AsyncClient if asynchronous else httpx.Client
+    return cls(
+        timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=PROVIDER_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=PROVIDER_MAX_CONNECTIONS,
+                            max_keepalive_connections=PROVIDER_MAX_KEEPALIVE),
+    )
+
+def _key_error(provider):
+    if provider == "openai":
+        if not OPENAI_API_KEY or not OPENAI_API_KEY.startswith("sk-"):
+            return "OpenAI key missing/invalid. Set OPENAI_API_KEY (starts with 'sk-')."
+    elif not GROQ_API_KEY or not GROQ_API_KEY.startswith("gsk_"):
+        return "Groq key missing/invalid. Set GROQ_API_KEY (starts with 'gsk_')."
+    return None
+
+def _build_client(provider, asynchronous=False):
+    # SDKs are imported on first use so a rerun that never talks to a provider
+    # does not pay for them. SDK retries are off: the Dispatcher owns retrying.
+    if provider == "openai":
+        from openai import AsyncOpenAI, OpenAI
+        cls = AsyncOpenAI if asynchronous else OpenAI
+        return cls(api_key=OPENAI_API_KEY, http_client=_http_client(asynchronous), max_retries=0)
+    from groq import AsyncGroq, Groq
+    cls = AsyncGroq if asynchronous else Groq
+    return cls(api_key=GROQ_API_KEY, http_client=_http_client(asynchronous), max_retries=0)
+
+def get_provider_client(provider: str, asynchronous=False):
+    # asynchronous=True returns the AsyncOpenAI/AsyncGroq flavour (used by api.py)
+    provider = "openai" if provider.lower() == "openai" else "groq"
+    err = _key_error(provider)
+    if err:
+        return None, None, err
+
+    registry = _async_clients if asynchronous else _clients
+    client = registry.get(provider)
+    if client is None:
+        with _clients_lock:
+            client = registry.get(provider)
+            if client is None:
+                try:
+                    client = _build_client(provider, asynchronous)
+                except Exception as e:
+                    name = "OpenAI" if provider == "openai" else "Groq"
+                    return None, None, f"Failed to init {name} client: {e}"
+                registry[provider] = client
+    return client, DEFAULT_MODELS[provider], None
+
+def close_provider_clients():
+    # Sync clients only; async ones belong to an event loop (aclose_provider_clients)
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+async def aclose_provider_clients():
+    # Call from the loop the async clients were used on, before it stops
+    with _clients_lock:
+        clients = list(_async_clients.values())
+        _async_clients.clear()
+    for client in clients:
+        await client.close()
+
+atexit.register(close_provider_clients)
+
+# ---- Chat completions --------------------------------------------------------
+def llm_chat(provider: str, client, model: str, messages, max_tokens=300, temperature=0.7, stream=False,
+             timeout=None):
+    extra = {"timeout": timeout} if timeout is not None else {}
+    if stream:
+        return _llm_chat_stream(client, model, messages, max_tokens, temperature, extra)
+    resp = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        **extra
+    )
+    return resp.choices[0].message.content.strip()
+
+def _llm_chat_stream(client, model, messages, max_tokens, temperature, extra=None):
+    # Groq and OpenAI share the same chunk shape: choices[0].delta.content
+    resp = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True,
+        **(extra or {})
+    )
+    try:
+        for chunk in resp:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        # Closing the stream drops the HTTP response if the consumer stops early
+        close = getattr(resp, "close", None)
+        if close:
+            close()
+
+async def allm_chat(client, model, messages, max_tokens=300, temperature=0.7, timeout=None):
+    extra = {"timeout": timeout} if timeout is not None else {}
+    resp = await client.chat.completions.create(
+        model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, **extra)
+    return resp.choices[0].message.content.strip()
+
+async def _allm_chat_stream(client, model, messages, max_tokens, temperature, timeout=None):
+    extra = {"timeout": timeout} if timeout is not None else {}
+    resp = await client.chat.completions.create(
+        model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True, **extra)
+    try:
+        async for chunk in resp:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        await resp.close()
+
+# ---- Resilient dispatch ------------------------------------------------------
+def is_retryable(e):
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    # openai/groq connection and timeout errors carry no status code
+    return type(e).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(e, (TimeoutError, ConnectionError))
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failures; lets traffic probe again after `cooldown` seconds."""
+
+    def __init__(self, failures=5, cooldown=30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def record_success(self):
+        with self._lock:
+            self._count = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._count += 1
+            # A failed half-open probe re-opens the circuit for another cooldown
+            if self._count >= self.failures or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+
+class Dispatcher:
+    """Routes chat calls across providers with deadlines, retries, breakers and hedging.
+
+    Each provider attempt gets a deadline (PROVIDER_DEADLINES) that bounds all of
+    its retries. Retryable errors back off with full jitter. Providers whose
+    breaker is open are skipped in favour of the other one. In hedged mode the
+    secondary provider is started when the primary has not produced a first
+    token within its recent p95 time-to-first-token; the first to answer wins.
+    """
+
+    def __init__(self, deadlines=None, retries=2, breaker_failures=5, breaker_cooldown=30,
+                 hedge=False, hedge_default_delay=2.0, hedge_min_delay=0.25):
+        self.deadlines = deadlines or {}
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.breakers = {p: CircuitBreaker(breaker_failures, breaker_cooldown) for p in DEFAULT_MODELS}
+        self._ttft = {p: deque(maxlen=200) for p in DEFAULT_MODELS}
+
+    def chat(self, provider, messages, max_tokens=300, temperature=0.7, hedge=None):
+        def start(p, client, model, timeout):
+            return llm_chat(p, client, model, messages, max_tokens, temperature, timeout=timeout)
+        return self._dispatch(provider, start, hedge)[1]
+
+    def stream(self, provider, messages, max_tokens=300, temperature=0.7, hedge=None):
+        # Retries and failover happen before the first token; after that a
+        # failure surfaces to the caller, which keeps the partial answer.
+        def start(p, client, model, timeout):
+            gen = llm_chat(p, client, model, messages, max_tokens, temperature, stream=True, timeout=timeout)
+            try:
+                return next(gen, ""), gen
+            except BaseException:
+                gen.close()
+                raise
+        _, (first, gen) = self._dispatch(provider, start, hedge, discard=lambda r: r[1].close())
+        try:
+            if first:
+                yield first
+            yield from gen
+        finally:
+            gen.close()
+
+    def hedge_delay(self, provider):
+        samples = sorted(self._ttft[provider])
+        if len(samples) < 20:
+            return self.hedge_default_delay
+        return max(percentile(samples, 0.95), self.hedge_min_delay)
+
+    def _order(self, provider):
+        provider = provider.lower()
+        names = [provider] + [p for p in DEFAULT_MODELS if p != provider]
+        usable = [p for p in names if self.breakers[p].allow() and _key_error(p) is None]
+        return usable or [provider]  # everything open: still try the preferred one
+
+    def _dispatch(self, provider, start, hedge, discard=None):
+        order = self._order(provider)
+        hedge = self.hedge if hedge is None else hedge
+        if hedge and len(order) > 1:
+            return self._hedged(order[0], order[1], start, discard)
+        err = None
+        for p in order:
+            try:
+                return p, self._attempt(p, start)
+            except Exception as e:
+                err = e
+                log.warning("provider %s failed: %s", p, e)
+        raise err
+
+    def _attempt(self, provider, start):
+        client, model, init_err = get_provider_client(provider)
+        if init_err:
+            raise RuntimeError(init_err)
+        began = time.monotonic()
+        deadline = began + self.deadlines.get(provider, PROVIDER_TIMEOUT)
+        for attempt in range(self.retries + 1):
+            try:
+                result = start(provider, client, model, max(deadline - time.monotonic(), 0.1))
+            except Exception as e:
+                backoff = self._on_failure(provider, e, attempt, deadline)
+                time.sleep(backoff)
+                continue
+            self._on_success(provider, began)
+            return result
+
+    def _on_failure(self, provider, e, attempt, deadline):
+        # Re-raises unless another attempt fits; returns the backoff to sleep
+        if not is_retryable(e):
+            raise e
+        breaker = self.breakers[provider]
+        breaker.record_failure()
+        backoff = random.uniform(0, min(8.0, 0.5 * 2 ** attempt))  # full jitter
+        if attempt == self.retries or not breaker.allow() or time.monotonic() + backoff >= deadline:
+            raise e
+        return backoff
+
+    def _on_success(self, provider, began):
+        self.breakers[provider].record_success()
+        self._ttft[provider].append(time.monotonic() - began)
+
+    def _hedged(self, primary, secondary, start, discard):
+        results = queue.Queue()
+
+        def run(p):
+            try:
+                results.put((p, self._attempt(p, start), None))
+            except Exception as e:
+                results.put((p, None, e))
+
+        threading.Thread(target=run, args=(primary,), daemon=True).start()
+        launched, errors = 1, []
+        try:
+            got = results.get(timeout=self.hedge_delay(primary))
+        except queue.Empty:
+            got = None
+        if got is None or got[2] is not None:
+            log.info("hedging %s request to %s", primary, secondary)
+            threading.Thread(target=run, args=(secondary,), daemon=True).start()
+            launched = 2
+        while True:
+            p, result, e = got if got is not None else results.get()
+            got = None
+            if e is None:
+                if launched - len(errors) > 1 and discard:
+                    # Release the losing request (e.g. close its stream) once it lands
+                    def drain():
+                        loser = results.get()
+                        if loser[2] is None:
+                            discard(loser[1])
+                    threading.Thread(target=drain, daemon=True).start()
+                return p, result
+            errors.append(e)
+            if len(errors) == launched:
+                raise errors[0]
+
+    # ---- asyncio flavour (same breakers, samples and policy) ----
+    async def achat(self, provider, messages, max_tokens=300, temperature=0.7, hedge=None):
+        async def start(p, client, model, timeout):
+            return await allm_chat(client, model, messages, max_tokens, temperature, timeout)
+        return (await self._adispatch(provider, start, hedge))[1]
+
+    async def astream(self, provider, messages, max_tokens=300, temperature=0.7, hedge=None):
+        async def start(p, client, model, timeout):
+            gen = _allm_chat_stream(client, model, messages, max_tokens, temperature, timeout)
+            try:
+                return await anext(gen, ""), gen
+            except BaseException:
+                await gen.aclose()
+                raise
+        async def discard(result):
+            await result[1].aclose()
+        _, (first, gen) = await self._adispatch(provider, start, hedge, discard)
+        try:
+            if first:
+                yield first
+            async for delta in gen:
+                yield delta
+        finally:
+            await gen.aclose()
+
+    async def _adispatch(self, provider, start, hedge, discard=None):
+        order = self._order(provider)
+        hedge = self.hedge if hedge is None else hedge
+        if hedge and len(order) > 1:
+            return await self._ahedged(order[0], order[1], start, discard)
+        err = None
+        for p in order:
+            try:
+                return p, await self._aattempt(p, start)
+            except Exception as e:
+                err = e
+                log.warning("provider %s failed: %s", p, e)
+        raise err
+
+    async def _aattempt(self, provider, start):
+        client, model, init_err = get_provider_client(provider, asynchronous=True)
+        if init_err:
+            raise RuntimeError(init_err)
+        began = time.monotonic()
+        deadline = began + self.deadlines.get(provider, PROVIDER_TIMEOUT)
+        for attempt in range(self.retries + 1):
+            try:
+                result = await start(provider, client, model, max(deadline - time.monotonic(), 0.1))
+            except Exception as e:
+                await asyncio.sleep(self._on_failure(provider, e, attempt, deadline))
+                continue
+            self._on_success(provider, began)
+            return result
+
+    async def _ahedged(self, primary, secondary, start, discard):
+        tasks = {asyncio.ensure_future(self._aattempt(primary, start)): primary}
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(primary))
+        if not done or next(iter(done)).exception() is not None:
+            log.info("hedging %s request to %s", primary, secondary)
+            tasks[asyncio.ensure_future(self._aattempt(secondary, start))] = secondary
+        pending, errors = set(tasks), []
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                if discard:
+                    # Release the losing request (e.g. close its stream) once it lands
+                    def release(t):
+                        if not t.cancelled() and t.exception() is None:
+                            asyncio.ensure_future(discard(t.result()))
+                    for loser in (pending | done) - {task}:
+                        loser.add_done_callback(release)
+                return tasks[task], task.result()
+        raise errors[0]
+
+dispatcher = Dispatcher(PROVIDER_DEADLINES, PROVIDER_RETRIES, BREAKER_FAILURES, BREAKER_COOLDOWN,
+                        HEDGE_REQUESTS, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY)
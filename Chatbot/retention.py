@@ -0,0 +1,121 @@
+# retention.py
+
+# Housekeeping for the chat log (run from cron or by hand):
+#
+#   python retention.py --archive 90    # move turns older than 90 days to ARCHIVE_DB
+#   python retention.py --compact       # compress rows written before migration 9
+#   python retention.py --vacuum        # hand freed pages back to the filesystem
+
+import argparse
+import logging
+import sqlite3
+from config import ARCHIVE_DB, COMPRESS_MIN_BYTES, RETENTION_DAYS
+from storage import get_conn, pack
+
+log = logging.getLogger(__name__)
+
+# ---- Archive -----------------------------------------------------------------
+def _archive_conn(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        user_text,
+        attachment_summary,
+        bot_text,
+        created_at TIMESTAMP
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user ON chats (username, id)")
+    return conn
+
+def archive(days, path=ARCHIVE_DB, batch=2000):
+    # Copies turns older than `days` to the archive database (compressed, ids
+    # kept) and deletes them here, one batch per transaction. The archive is
+    # committed before the rows are deleted, so an interruption can at worst
+    # leave a copy in both places, never in neither. Returns the rows moved.
+    total = 0
+    dest = _archive_conn(path)
+    try:
+        while True:
+            with get_conn() as conn:
+                rows = conn.execute("""SELECT id, username, user_text, attachment_summary, bot_text, created_at
+                                       FROM chats_text WHERE created_at < datetime('now', ?)
+                                       ORDER BY id LIMIT ?""", (f"-{days} days", batch)).fetchall()
+            if not rows:
+                break
+            with dest:
+                dest.executemany("INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(i, u, pack(q), pack(a), pack(b), t) for i, u, q, a, b, t in rows])
+            with get_conn() as conn:
+                conn.executemany("DELETE FROM chats WHERE id=?", [(r[0],) for r in rows])
+            total += len(rows)
+            log.info("archive: moved %d rows", total)
+    finally:
+        dest.close()
+    prune_attachments()
+    return total
+
+def prune_attachments():
+    # Attachment summaries no remaining turn points at
+    with get_conn() as conn:
+        return conn.execute("""DELETE FROM chat_attachments WHERE sha256 NOT IN
+                               (SELECT attachment_ref FROM chats WHERE attachment_ref IS NOT NULL)""").rowcount
+
+# ---- Compaction --------------------------------------------------------------
+def compact(batch=2000):
+    # Compresses the long text columns of rows stored before migration 9.
+    # Returns the rows rewritten.
+    total, last = 0, 0
+    while True:
+        with get_conn() as conn:
+            rows = conn.execute("""SELECT id, user_text, attachment_summary, bot_text FROM chats
+                                   WHERE id > ? AND (
+                                         (typeof(user_text) = 'text' AND length(CAST(user_text AS BLOB)) >= ?)
+                                         OR (typeof(attachment_summary) = 'text'
+                                             AND length(CAST(attachment_summary AS BLOB)) >= ?)
+                                         OR (typeof(bot_text) = 'text' AND length(CAST(bot_text AS BLOB)) >= ?))
+                                   ORDER BY id LIMIT ?""",
+                               (last, COMPRESS_MIN_BYTES, COMPRESS_MIN_BYTES, COMPRESS_MIN_BYTES, batch)).fetchall()
+            if not rows:
+                return total
+            for chat_id, user_text, attachment_summary, bot_text in rows:
+                conn.execute("UPDATE chats SET user_text=?, attachment_summary=?, bot_text=? WHERE id=?",
+                             (_repack(user_text), _repack(attachment_summary), _repack(bot_text), chat_id))
+        total += len(rows)
+        last = rows[-1][0]
+        log.info("compact: rewrote %d rows", total)
+
+def _repack(value):
+    return value if isinstance(value, bytes) else pack(value)
+
+# ---- Vacuum ------------------------------------------------------------------
+def vacuum(pages=0):
+    # The first run switches the database to incremental auto-vacuum, which
+    # needs one full VACUUM; later runs free `pages` pages (0 = all) without
+    # rewriting the file.
+    with get_conn() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            return
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+        log.info("vacuum: %d free pages before", free)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive, compress and vacuum the chat log")
+    parser.add_argument("--archive", type=float, metavar="DAYS", nargs="?", const=RETENTION_DAYS,
+                        help=f"move turns older than DAYS to {ARCHIVE_DB} (default RETENTION_DAYS)")
+    parser.add_argument("--archive-db", default=ARCHIVE_DB)
+    parser.add_argument("--compact", action="store_true", help="compress rows saved before compression existed")
+    parser.add_argument("--vacuum", type=int, metavar="PAGES", nargs="?", const=0,
+                        help="release free pages (all by default)")
+    parser.add_argument("--batch", type=int, default=2000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    if args.archive:
+        print(f"archived {archive(args.archive, args.archive_db, args.batch)} rows")
+    if args.compact:
+        print(f"compacted {compact(args.batch)} rows")
+    if args.vacuum is not None:
+        vacuum(args.vacuum)
@@ -0,0 +1,146 @@
+# retrieval.py
+
+import importlib.util
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from config import RETRIEVAL_DIR, RETRIEVAL_CHUNK_CHARS, RETRIEVAL_CHUNK_OVERLAP, RETRIEVAL_TOP_K, EXTRACT_MAX_CHARS
+
+# Optional: without NumPy/SciPy attachments fall back to plain truncation
+HAS_RETRIEVAL = all(importlib.util.find_spec(m) is not None for m in ("numpy", "scipy"))
+
+_TOKEN = re.compile(r"\w+")
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+def chunk_text(text, size=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    # Fixed-size windows, nudged back to the last whitespace so words stay whole
+    chunks, start = [], 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind(" ", start + size // 2, end)
+            end = cut if cut != -1 else end
+        chunks.append(text[start:end].strip())
+        if end == len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [c for c in chunks if c]
+
+# ---- BM25 index --------------------------------------------------------------
+class BM25Index:
+    """Okapi BM25 over a chunk x term sparse matrix.
+
+    Term weights are precomputed at build time, so a query is a column slice
+    and a row sum over the matrix.
+    """
+
+    def __init__(self, chunks, vocab, weights):
+        self.chunks = chunks
+        self.vocab = vocab          # term -> column
+        self.weights = weights      # scipy.sparse.csc_matrix, chunks x terms
+
+    @classmethod
+    def build(cls, chunks, k1=1.5, b=0.75):
+        import numpy as np
+        from scipy import sparse
+
+        vocab, rows, cols, vals = {}, [], [], []
+        for i, chunk in enumerate(chunks):
+            for term, tf in Counter(tokenize(chunk)).items():
+                rows.append(i)
+                cols.append(vocab.setdefault(term, len(vocab)))
+                vals.append(tf)
+        n = len(chunks)
+        tf = sparse.csr_matrix((np.array(vals, dtype=np.float32), (rows, cols)), shape=(n, len(vocab)))
+
+        df = np.bincount(tf.indices, minlength=len(vocab))
+        idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        dl = np.asarray(tf.sum(axis=1)).ravel()
+        norm = k1 * (1 - b + b * dl / max(dl.mean(), 1))
+        row_of = np.repeat(np.arange(n), np.diff(tf.indptr))
+        tf.data = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norm[row_of])
+        return cls(chunks, vocab, tf.tocsc())
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        # Indices of the k best chunks in document order; [] if nothing matches
+        import numpy as np
+        cols = [self.vocab[t] for t in tokenize(query) if t in self.vocab]
+        if not cols:
+            return []
+        scores = np.asarray(self.weights[:, cols].sum(axis=1)).ravel()
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return sorted(int(i) for i in top if scores[i] > 0)
+
+    def save(self, path):
+        import numpy as np
+        terms = [None] * len(self.vocab)
+        for term, col in self.vocab.items():
+            terms[col] = term
+        w = self.weights
+        tmp = path + ".tmp.npz"
+        np.savez_compressed(tmp, data=w.data, indices=w.indices, indptr=w.indptr, shape=np.array(w.shape),
+                            terms=np.array(terms, dtype=str), chunks=np.array(self.chunks, dtype=str))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        from scipy import sparse
+        with np.load(path) as z:
+            weights = sparse.csc_matrix((z["data"], z["indices"], z["indptr"]), shape=tuple(z["shape"]))
+            vocab = {t: i for i, t in enumerate(z["terms"].tolist())}
+            return cls(z["chunks"].tolist(), vocab, weights)
+
+# ---- Per-document indexes ----------------------------------------------------
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+INDEX_ITEMS = 16
+
+def get_index(sha256, text):
+    # Built once per document and persisted to RETRIEVAL_DIR, so later sessions
+    # and processes just load it. Keyed by content hash and text length: a PDF
+    # that timed out is indexed from the pages read so far (a prefix of the
+    # full text) and indexed again once the rest has been read.
+    key = f"{sha256}-{len(text)}"
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    path = os.path.join(RETRIEVAL_DIR, f"{key}.npz")
+    if os.path.exists(path):
+        index = BM25Index.load(path)
+    else:
+        index = BM25Index.build(chunk_text(text))
+        os.makedirs(RETRIEVAL_DIR, exist_ok=True)
+        index.save(path)
+        _remove_older(sha256, len(text))
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > INDEX_ITEMS:
+            _indexes.popitem(last=False)
+    return index
+
+def _remove_older(sha256, length):
+    # Indexes of the same document built from less of its text (and the
+    # unversioned name used before); a larger one is left alone
+    for name in os.listdir(RETRIEVAL_DIR):
+        stem = name[:-len(".npz")] if name.endswith(".npz") else ""
+        if stem == sha256 or (stem.startswith(sha256 + "-") and stem[65:].isdigit() and int(stem[65:]) < length):
+            try:
+                os.remove(os.path.join(RETRIEVAL_DIR, name))
+            except OSError:
+                pass  # another process got there first
+
+def relevant_context(sha256, text, query, k=RETRIEVAL_TOP_K):
+    # The part of a document worth sending with `query`: the whole text when it
+    # is short, otherwise the top-k BM25 chunks (or the opening chunks if no
+    # term matches).
+    if len(text) <= EXTRACT_MAX_CHARS or not HAS_RETRIEVAL:
+        return text[:EXTRACT_MAX_CHARS]
+    index = get_index(sha256, text)
+    hits = index.search(query, k) or list(range(min(k, len(index.chunks))))
+    return "\n…\n".join(index.chunks[i] for i in hits)
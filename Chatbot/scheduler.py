@@ -0,0 +1,297 @@
+# scheduler.py
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from config import (RATE_USER_RPM, RATE_USER_TPM, RATE_GLOBAL_RPM, RATE_GLOBAL_TPM, SCHEDULER_MAX_WAIT,
+                    SHARED_RESULT_TTL)
+from shared import LocalState, state
+from stats import percentile
+
+class Flight:
+    """One upstream call whose deltas fan out to every coalesced caller."""
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self._cond = threading.Condition()
+
+    def publish(self, delta):
+        with self._cond:
+            self.parts.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done, self.error = True, error
+            self._cond.notify_all()
+
+    def follow(self):
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.parts) > i or self.done)
+                new, done, error = self.parts[i:], self.done, self.error
+            i += len(new)
+            yield from new
+            if done and i == len(self.parts):
+                if error:
+                    raise error
+                return
+
+    async def afollow(self, poll=0.02):
+        i = 0
+        while True:
+            with self._cond:
+                new, done, error = self.parts[i:], self.done, self.error
+            i += len(new)
+            for delta in new:
+                yield delta
+            if done and i == len(self.parts):
+                if error:
+                    raise error
+                return
+            if not new:
+                await asyncio.sleep(poll)
+
+class Scheduler:
+    """Admission control in front of the providers.
+
+    - identical in-flight requests (same cache key) share one upstream call,
+      also across worker processes when `state` is shared
+    - per-user and global token buckets, in requests/min and estimated tokens/min
+    - waiting requests are admitted round-robin across users, so one user's
+      backlog cannot starve the others; they wait (up to `max_wait`) rather
+      than fail
+
+    Buckets come from `state` under names prefixed with `name`, so schedulers
+    with the same name in different processes draw on the same limits.
+    """
+
+    def __init__(self, user_rpm=20, user_tpm=20000, global_rpm=60, global_tpm=60000, max_wait=120,
+                 state=None, name="ui"):
+        self.user_rpm, self.user_tpm = user_rpm, user_tpm
+        self.max_wait = max_wait
+        self.state = state or LocalState()
+        self.name = name
+        self._global = (self.state.bucket(f"{name}:rpm", global_rpm), self.state.bucket(f"{name}:tpm", global_tpm))
+        self._users = {}                 # user -> (request bucket, token bucket)
+        self._queues = OrderedDict()     # user -> deque of waiting tickets, in round-robin order
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._waits = deque(maxlen=500)
+        self.coalesced = 0
+        self.coalesced_remote = 0        # answers taken from another process's call
+
+    # ---- single-flight ----
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    async def _off_loop(self, fn, *args):
+        # Shared state is SQLite: a call can wait on another process's write
+        # lock, which must not stall the event loop
+        if self.state.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def stream(self, key, user, tokens, start):
+        # `start()` returns an iterator of deltas and only runs once admitted;
+        # callers with the same key meanwhile replay the leader's deltas.
+        # Another process already calling for `key` answers in one delta.
+        flight, leader = self._join(key)
+        if not leader:
+            yield from flight.follow()
+            return
+        err, owner, parts = None, None, []
+        try:
+            owner = self.state.claim(key, 2 * self.max_wait)
+            answer = None if owner else self._wait_remote(key)
+            if answer is not None:
+                flight.publish(answer)
+                yield answer
+                return
+            self.acquire(user, tokens)
+            for delta in start():
+                flight.publish(delta)
+                parts.append(delta)
+                yield delta
+            self.state.publish(key, "".join(parts), SHARED_RESULT_TTL)
+        except BaseException as e:
+            # GeneratorExit (the leader stopped reading) also ends the flight
+            err = e if isinstance(e, Exception) else RuntimeError("upstream call cancelled")
+            raise
+        finally:
+            self._land(key, flight, err, owner)
+
+    async def astream(self, key, user, tokens, start):
+        # asyncio flavour; `start()` returns an async iterator of deltas
+        flight, leader = self._join(key)
+        if not leader:
+            async for delta in flight.afollow():
+                yield delta
+            return
+        err, owner, parts = None, None, []
+        try:
+            owner = await self._off_loop(self.state.claim, key, 2 * self.max_wait)
+            answer = None if owner else await self._await_remote(key)
+            if answer is not None:
+                flight.publish(answer)
+                yield answer
+                return
+            await self.aacquire(user, tokens)
+            async for delta in start():
+                flight.publish(delta)
+                parts.append(delta)
+                yield delta
+            await self._off_loop(self.state.publish, key, "".join(parts), SHARED_RESULT_TTL)
+        except BaseException as e:
+            err = e if isinstance(e, Exception) else RuntimeError("upstream call cancelled")
+            raise
+        finally:
+            if owner and self.state.blocking:
+                # Not awaited, so the claim is released even when cancelled
+                asyncio.get_running_loop().run_in_executor(None, self.state.release, key, owner)
+                owner = None
+            self._land(key, flight, err, owner)
+
+    def _land(self, key, flight, err, owner=None):
+        if owner:
+            self.state.release(key, owner)
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.finish(err)
+
+    def _wait_remote(self, key, poll=0.05):
+        # The other process's answer, or None if it failed or took longer than
+        # max_wait; the caller then makes the call itself
+        deadline = time.monotonic() + self.max_wait
+        while time.monotonic() < deadline:
+            done, answer = self.state.poll(key)
+            if done:
+                break
+            time.sleep(poll)
+        else:
+            return None
+        if answer is not None:
+            with self._lock:
+                self.coalesced_remote += 1
+        return answer
+
+    async def _await_remote(self, key, poll=0.05):
+        deadline = time.monotonic() + self.max_wait
+        while time.monotonic() < deadline:
+            done, answer = await self._off_loop(self.state.poll, key)
+            if done:
+                break
+            await asyncio.sleep(poll)
+        else:
+            return None
+        if answer is not None:
+            with self._lock:
+                self.coalesced_remote += 1
+        return answer
+
+    # ---- admission ----
+    def acquire(self, user, tokens):
+        ticket = self._enqueue(user, tokens)
+        deadline = ticket[2] + self.max_wait
+        while not self._try_admit(ticket):
+            remaining = deadline - time.monotonic()
+            with self._cond:
+                if remaining <= 0:
+                    self._drop(ticket)
+                    raise TimeoutError(f"rate limited: waited {self.max_wait}s for a slot")
+                self._cond.wait(min(remaining, 0.05))
+
+    async def aacquire(self, user, tokens, poll=0.02):
+        ticket = self._enqueue(user, tokens)
+        deadline = ticket[2] + self.max_wait
+        try:
+            while True:
+                if await self._off_loop(self._try_admit, ticket):
+                    return
+                if time.monotonic() >= deadline:
+                    with self._cond:
+                        self._drop(ticket)
+                    raise TimeoutError(f"rate limited: waited {self.max_wait}s for a slot")
+                await asyncio.sleep(poll)
+        except asyncio.CancelledError:
+            with self._cond:
+                self._drop(ticket)
+            raise
+
+    def _enqueue(self, user, tokens):
+        ticket = (user, tokens, time.monotonic())
+        with self._cond:
+            self._queues.setdefault(user, deque()).append(ticket)
+            if user not in self._users:
+                self._users[user] = (self.state.bucket(f"{self.name}:user:{user}:rpm", self.user_rpm),
+                                     self.state.bucket(f"{self.name}:user:{user}:tpm", self.user_tpm))
+        return ticket
+
+    def _try_admit(self, ticket):
+        # Called without the lock. Walk users in round-robin order and admit
+        # the first head-of-queue ticket whose buckets allow it. The order is
+        # snapshotted under the lock; the buckets are read and charged outside
+        # it, since with shared state those are SQLite calls.
+        with self._lock:
+            order = [(user, queue[0], self._users[user]) for user, queue in self._queues.items()]
+        now = time.monotonic()
+        g_req, g_tok = self._global
+        if not (g_req.has(1, now) and g_tok.has(ticket[1], now)):
+            return False
+        for user, head, (u_req, u_tok) in order:
+            if u_req.has(1, now) and u_tok.has(head[1], now) and g_tok.has(head[1], now):
+                if head is not ticket:
+                    return False  # someone ahead in the fair order goes first
+                # Re-checked atomically: another thread or process may have
+                # taken from the same buckets since the checks above
+                if not self.state.take_all(((g_req, 1), (g_tok, head[1]), (u_req, 1), (u_tok, head[1]))):
+                    return False
+                with self._cond:
+                    queue = self._queues.get(user)
+                    if not queue or queue[0] is not ticket:
+                        return False  # dropped (timed out or cancelled) meanwhile
+                    queue.popleft()
+                    del self._queues[user]
+                    if queue:
+                        self._queues[user] = queue  # back of the round-robin order
+                    self._waits.append(now - ticket[2])
+                    self._cond.notify_all()
+                return True
+        return False
+
+    def _drop(self, ticket):
+        queue = self._queues.get(ticket[0])
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket[0]]
+        self._cond.notify_all()
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            depth = sum(len(q) for q in self._queues.values())
+            return {
+                "queue_depth": depth,
+                "waiting_users": len(self._queues),
+                "in_flight": len(self._flights),
+                "coalesced": self.coalesced,
+                "coalesced_remote": self.coalesced_remote,
+                "wait_p50": percentile(waits, 0.50),
+                "wait_p95": percentile(waits, 0.95),
+            }
+
+scheduler = Scheduler(RATE_USER_RPM, RATE_USER_TPM, RATE_GLOBAL_RPM, RATE_GLOBAL_TPM, SCHEDULER_MAX_WAIT, state)
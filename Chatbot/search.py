@@ -0,0 +1,116 @@
+# search.py
+
+# Full-text search over a user's chats (FTS5 table chats_fts over the chats_text
+# view, migrations 8 and 9).
+#
+#   python search.py --backfill     # index rows saved before the migration
+#   python search.py --optimize     # merge index segments after a large backfill
+
+import argparse
+import logging
+import re
+import threading
+from storage import get_conn
+
+log = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+SNIPPET_TOKENS = 12
+MIN_PREFIX = 3      # shorter prefixes match nearly every row
+
+def fts_query(text):
+    # Free text -> FTS5 query: every word must match, the last one (from 3
+    # characters on) as a prefix so results show up while typing. Quoting
+    # keeps FTS5 syntax characters in user input from turning into operators.
+    # None if there are no words.
+    words = _WORD.findall(text.lower())
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    if len(words[-1]) >= MIN_PREFIX:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+def search_chats(username, text, limit=20, offset=0):
+    """Best-ranked turns of `username` matching `text`, `limit` per page.
+
+    Returns (rows, has_more); rows are (id, created_at, user_snippet,
+    attachment_snippet, bot_snippet) with matches wrapped in ** **.
+    """
+    query = fts_query(text)
+    if query is None:
+        return [], False
+    # The username column narrows the match to this user's postings inside
+    # the index; the join then checks the exact name.
+    owner = " ".join(_WORD.findall(username.lower()))
+    if owner:
+        query = f'username : "{owner}" AND ({query})'
+    with get_conn() as conn:
+        rows = conn.execute(f"""
+            SELECT c.id, c.created_at,
+                   snippet(chats_fts, 1, '**', '**', '…', {SNIPPET_TOKENS}),
+                   snippet(chats_fts, 2, '**', '**', '…', {SNIPPET_TOKENS}),
+                   snippet(chats_fts, 3, '**', '**', '…', {SNIPPET_TOKENS})
+            FROM chats_fts JOIN chats c ON c.id = chats_fts.rowid
+            WHERE chats_fts MATCH ? AND c.username = ?
+            ORDER BY bm25(chats_fts, 0.0, 2.0, 0.5, 1.0)
+            LIMIT ? OFFSET ?""", (query, username, limit + 1, offset)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+# ---- Backfill ----------------------------------------------------------------
+def backfill_pending():
+    with get_conn() as conn:
+        upto, done = conn.execute("SELECT upto, done FROM chats_fts_backfill").fetchone()
+    return done < upto
+
+def backfill(batch=5000):
+    # Indexes pre-migration rows in id order, one short transaction per batch,
+    # so it can run while the app is serving and resume after an interruption.
+    total = 0
+    while True:
+        with get_conn() as conn:
+            upto, done = conn.execute("SELECT upto, done FROM chats_fts_backfill").fetchone()
+            if done >= upto:
+                return total
+            end = min(done + batch, upto)
+            c = conn.execute("""INSERT INTO chats_fts (rowid, username, user_text, attachment_summary, bot_text)
+                                SELECT id, username, user_text, attachment_summary, bot_text
+                                FROM chats_text WHERE id > ? AND id <= ?""", (done, end))
+            conn.execute("UPDATE chats_fts_backfill SET done = ?", (end,))
+            total += c.rowcount
+        log.info("search backfill: indexed up to id %d of %d", end, upto)
+
+_backfill_thread = None
+_backfill_lock = threading.Lock()
+
+def start_backfill():
+    # Runs backfill() once per process in the background if anything is left
+    global _backfill_thread
+    with _backfill_lock:
+        if _backfill_thread is not None or not backfill_pending():
+            return
+        _backfill_thread = threading.Thread(target=_run_backfill, name="search-backfill", daemon=True)
+        _backfill_thread.start()
+
+def _run_backfill():
+    try:
+        backfill()
+    except Exception:
+        log.exception("search backfill failed")
+
+def optimize():
+    with get_conn() as conn:
+        conn.execute("INSERT INTO chats_fts (chats_fts) VALUES ('optimize')")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the chat full-text index")
+    parser.add_argument("--backfill", action="store_true", help="index chats saved before search existed")
+    parser.add_argument("--optimize", action="store_true", help="merge index segments")
+    parser.add_argument("--batch", type=int, default=5000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    if args.backfill:
+        print(f"indexed {backfill(args.batch)} rows")
+    if args.optimize:
+        optimize()
@@ -0,0 +1,219 @@
+# shared.py
+
+# State that several worker processes (Streamlit or api.py, behind a load
+# balancer on one host) need to agree on: login sessions, rate-limit buckets
+# and which provider calls are already in flight. The response and extraction
+# caches need nothing here; their SQLite tiers in users.db are already shared.
+#
+# LocalState keeps all of it in the process (one worker). SQLiteState keeps it
+# in one SQLite file every worker opens; put it on tmpfs (/dev/shm) so the
+# small, frequent writes never wait on a disk.
+
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from config import SHARED_STATE_DB
+
+# ---- Token buckets -----------------------------------------------------------
+class TokenBucket:
+    """Continuous-refill bucket; `capacity` units refill over `period` seconds."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _level(self, now):
+        return min(self.capacity, self.level + (now - self.stamp) * self.rate)
+
+    def has(self, amount, now):
+        return self._level(now) >= min(amount, self.capacity)
+
+    def take(self, amount, now):
+        self.level = self._level(now) - min(amount, self.capacity)
+        self.stamp = now
+
+class SharedBucket:
+    """A TokenBucket whose level lives in SQLiteState, under `name`."""
+
+    def __init__(self, state, name, capacity, period=60.0):
+        self.state, self.name = state, name
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+
+    def has(self, amount, now=None):
+        return self.state.level(self, time.time()) >= min(amount, self.capacity)
+
+# ---- In-process backend ------------------------------------------------------
+class LocalState:
+    """Single worker: plain objects, no I/O."""
+
+    blocking = False  # whether calls may wait on I/O (async callers move them off the loop)
+
+    def __init__(self):
+        self._sessions = {}   # token -> (username, expires_at)
+        self._lock = threading.Lock()
+
+    def bucket(self, name, capacity, period=60.0):
+        return TokenBucket(capacity, period)
+
+    def take_all(self, takes):
+        # takes: [(bucket, amount)]; all or nothing
+        with self._lock:
+            now = time.monotonic()
+            if not all(bucket.has(amount, now) for bucket, amount in takes):
+                return False
+            for bucket, amount in takes:
+                bucket.take(amount, now)
+            return True
+
+    # ---- sessions ----
+    def session_new(self, username, ttl):
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._sessions[token] = (username, time.time() + ttl)
+        return token
+
+    def session_user(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session and session[1] < time.time():
+                del self._sessions[token]
+                session = None
+        return session[0] if session else None
+
+    def session_end(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    # ---- in-flight calls ----
+    # The Scheduler already coalesces within a process, so every claim succeeds
+    def claim(self, key, ttl):
+        return "local"
+
+    def poll(self, key):
+        return True, None
+
+    def publish(self, key, value, ttl):
+        pass
+
+    def release(self, key, owner):
+        pass
+
+# ---- Cross-process backend ---------------------------------------------------
+class SQLiteState(LocalState):
+    """Every worker on the host opens the same file.
+
+    Buckets are read-modify-written inside BEGIN IMMEDIATE, so a request is
+    charged against the shared limits exactly once whichever worker admits
+    it. A provider call is claimed by key: workers that find a live claim
+    wait for the claimant's published answer instead of repeating the call.
+    """
+
+    blocking = True
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, stamp REAL);
+    CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, username TEXT, expires REAL);
+    CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, owner TEXT, expires REAL);
+    CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, expires REAL);
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit; the multi-statement updates open their own transaction
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")   # nothing here has to survive a host crash
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def bucket(self, name, capacity, period=60.0):
+        return SharedBucket(self, name, capacity, period)
+
+    def level(self, bucket, now, conn=None):
+        row = (conn or self._conn()).execute("SELECT level, stamp FROM buckets WHERE name=?",
+                                             (bucket.name,)).fetchone()
+        if row is None:
+            return bucket.capacity
+        return min(bucket.capacity, row[0] + (now - row[1]) * bucket.rate)
+
+    def take_all(self, takes):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            for bucket, amount in takes:
+                level = self.level(bucket, now, conn)
+                amount = min(amount, bucket.capacity)
+                if level < amount:
+                    return False
+                levels.append((bucket.name, level - amount, now))
+            conn.executemany("INSERT OR REPLACE INTO buckets (name, level, stamp) VALUES (?, ?, ?)", levels)
+            conn.execute("COMMIT")
+            return True
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+    # ---- sessions ----
+    def session_new(self, username, ttl):
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+        conn.execute("INSERT INTO sessions VALUES (?, ?, ?)", (token, username, now + ttl))
+        return token
+
+    def session_user(self, token):
+        row = self._conn().execute("SELECT username FROM sessions WHERE token=? AND expires >= ?",
+                                   (token, time.time())).fetchone()
+        return row[0] if row else None
+
+    def session_end(self, token):
+        self._conn().execute("DELETE FROM sessions WHERE token=?", (token,))
+
+    # ---- in-flight calls ----
+    def claim(self, key, ttl):
+        # Owner token if this worker now holds the call for `key`, else None.
+        # An expired claim (its worker died) is taken over.
+        owner, now = f"{os.getpid()}-{secrets.token_hex(4)}", time.time()
+        c = self._conn().execute("""INSERT INTO flights (key, owner, expires) VALUES (?, ?, ?)
+                                    ON CONFLICT (key) DO UPDATE SET owner=excluded.owner, expires=excluded.expires
+                                    WHERE flights.expires < ?""", (key, owner, now + ttl, now))
+        return owner if c.rowcount == 1 else None
+
+    def poll(self, key):
+        # (True, answer) once published; (True, None) if the claimant gave up
+        # without one; (False, None) while it is still working
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM results WHERE key=? AND expires >= ?", (key, now)).fetchone()
+        if row:
+            return True, row[0]
+        live = conn.execute("SELECT 1 FROM flights WHERE key=? AND expires >= ?", (key, now)).fetchone()
+        return live is None, None
+
+    def publish(self, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("DELETE FROM results WHERE expires < ?", (now,))
+        conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, value, now + ttl))
+
+    def release(self, key, owner):
+        self._conn().execute("DELETE FROM flights WHERE key=? AND owner=?", (key, owner))
+
+state = SQLiteState(SHARED_STATE_DB) if SHARED_STATE_DB else LocalState()
@@ -0,0 +1,16 @@
+# stats.py
+
+# The one percentile rule used for every latency figure (admin panel, /metrics,
+# /healthz, hedging, benchmarks, batch summaries), so they agree on the same data
+
+def percentile(sorted_values, q):
+    # Nearest rank; stable enough to diff between runs
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))]
+
+def summarize_ms(samples):
+    values = sorted(s * 1000 for s in samples)
+    return {"p50": round(percentile(values, 0.50), 3), "p95": round(percentile(values, 0.95), 3),
+            "p99": round(percentile(values, 0.99), 3), "max": round(values[-1], 3) if values else 0.0,
+            "mean": round(sum(values) / len(values), 3) if values else 0.0}
@@ -0,0 +1,495 @@
+# storage.py
+
+import atexit
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from config import COMPRESS_MIN_BYTES
+
+DB_PATH = "users.db"
+POOL_SIZE = 8
+
+# Applied in order; PRAGMA user_version records the last one that ran, so each
+# step runs exactly once per database and the check runs once per process.
+MIGRATIONS = [
+    # 1: original schema (IF NOT EXISTS keeps pre-migration databases intact)
+    """
+    CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT);
+    CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT,
+        user_text TEXT,
+        attachment_summary TEXT,
+        bot_text TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    # 2: history loads, keyset pages and deletes all filter on username
+    "CREATE INDEX IF NOT EXISTS idx_chats_username_id ON chats (username, id);",
+    # 3: persistent tier of the LLM response cache (see cache.py)
+    """
+    CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        response TEXT,
+        size INTEGER,
+        created_at REAL,
+        last_access REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_response_cache_last_access ON response_cache (last_access);
+    """,
+    # 4: extracted attachment text keyed by file content (see extract.py)
+    """
+    CREATE TABLE IF NOT EXISTS extractions (
+        sha256 TEXT,
+        kind TEXT,
+        budget INTEGER,
+        text TEXT,
+        meta TEXT,
+        PRIMARY KEY (sha256, kind, budget)
+    );
+    """,
+    # 5: rolling summary of turns that fell out of the prompt window (see context.py)
+    """
+    CREATE TABLE IF NOT EXISTS chat_summaries (
+        username TEXT PRIMARY KEY,
+        summary TEXT,
+        upto_id INTEGER
+    );
+    """,
+    # 6: per-stage request timings (see metrics.py)
+    """
+    CREATE TABLE IF NOT EXISTS metrics (
+        ts REAL,
+        trace TEXT,
+        stage TEXT,
+        duration_ms REAL,
+        provider TEXT,
+        model TEXT,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        cache_hit INTEGER,
+        error INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_metrics_ts ON metrics (ts);
+    """,
+    # 7: content-addressed uploads and who uploaded them (see blobs.py)
+    """
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER,
+        mime TEXT,
+        created_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS blob_refs (
+        username TEXT,
+        sha256 TEXT,
+        filename TEXT,
+        created_at REAL,
+        PRIMARY KEY (username, sha256, filename)
+    );
+    CREATE INDEX IF NOT EXISTS idx_blob_refs_sha256 ON blob_refs (sha256);
+    """,
+    # 8: full-text index over chats (see search.py). Rows that existed before
+    # this migration are indexed by search.backfill(); until it gets to a row,
+    # the delete/update triggers leave that row alone.
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(
+        username, user_text, attachment_summary, bot_text,
+        content='chats', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+        prefix='3 4 5'  -- search-as-you-type prefixes read one posting list
+    );
+    CREATE TABLE IF NOT EXISTS chats_fts_backfill (upto INTEGER, done INTEGER);
+    INSERT INTO chats_fts_backfill SELECT IFNULL(MAX(id), 0), 0 FROM chats;
+    CREATE TRIGGER IF NOT EXISTS chats_fts_insert AFTER INSERT ON chats BEGIN
+        INSERT INTO chats_fts (rowid, username, user_text, attachment_summary, bot_text)
+        VALUES (new.id, new.username, new.user_text, new.attachment_summary, new.bot_text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chats_fts_delete AFTER DELETE ON chats
+    WHEN old.id > (SELECT upto FROM chats_fts_backfill) OR old.id <= (SELECT done FROM chats_fts_backfill) BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, username, user_text, attachment_summary, bot_text)
+        VALUES ('delete', old.id, old.username, old.user_text, old.attachment_summary, old.bot_text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chats_fts_update AFTER UPDATE ON chats
+    WHEN old.id > (SELECT upto FROM chats_fts_backfill) OR old.id <= (SELECT done FROM chats_fts_backfill) BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, username, user_text, attachment_summary, bot_text)
+        VALUES ('delete', old.id, old.username, old.user_text, old.attachment_summary, old.bot_text);
+        INSERT INTO chats_fts (rowid, username, user_text, attachment_summary, bot_text)
+        VALUES (new.id, new.username, new.user_text, new.attachment_summary, new.bot_text);
+    END;
+    """,
+    # 9: large chat columns are stored zlib-compressed (BLOB; see pack()) and
+    # attachment summaries once per content hash. chats_text is the readable
+    # view; the full-text index is rebuilt over it by search.backfill().
+    """
+    ALTER TABLE chats ADD COLUMN attachment_ref TEXT;
+    CREATE TABLE IF NOT EXISTS chat_attachments (sha256 TEXT PRIMARY KEY, body);
+    CREATE VIEW IF NOT EXISTS chats_text AS
+        SELECT c.id, c.username, inflate(c.user_text) AS user_text,
+               COALESCE((SELECT inflate(a.body) FROM chat_attachments a WHERE a.sha256 = c.attachment_ref),
+                        inflate(c.attachment_summary)) AS attachment_summary,
+               inflate(c.bot_text) AS bot_text, c.created_at
+        FROM chats c;
+    DROP TRIGGER IF EXISTS chats_fts_insert;
+    DROP TRIGGER IF EXISTS chats_fts_delete;
+    DROP TRIGGER IF EXISTS chats_fts_update;
+    DROP TABLE IF EXISTS chats_fts;
+    CREATE VIRTUAL TABLE chats_fts USING fts5(
+        username, user_text, attachment_summary, bot_text,
+        content='chats_text', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+        prefix='3 4 5'
+    );
+    UPDATE chats_fts_backfill SET upto = (SELECT IFNULL(MAX(id), 0) FROM chats), done = 0;
+    CREATE TRIGGER chats_fts_insert AFTER INSERT ON chats BEGIN
+        INSERT INTO chats_fts (rowid, username, user_text, attachment_summary, bot_text)
+        SELECT id, username, user_text, attachment_summary, bot_text FROM chats_text WHERE id = new.id;
+    END;
+    CREATE TRIGGER chats_fts_delete AFTER DELETE ON chats
+    WHEN old.id > (SELECT upto FROM chats_fts_backfill) OR old.id <= (SELECT done FROM chats_fts_backfill) BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, username, user_text, attachment_summary, bot_text)
+        VALUES ('delete', old.id, old.username, inflate(old.user_text),
+                COALESCE((SELECT inflate(body) FROM chat_attachments WHERE sha256 = old.attachment_ref),
+                         inflate(old.attachment_summary)),
+                inflate(old.bot_text));
+    END;
+    CREATE TRIGGER chats_fts_update AFTER UPDATE ON chats
+    WHEN old.id > (SELECT upto FROM chats_fts_backfill) OR old.id <= (SELECT done FROM chats_fts_backfill) BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, username, user_text, attachment_summary, bot_text)
+        VALUES ('delete', old.id, old.username, inflate(old.user_text),
+                COALESCE((SELECT inflate(body) FROM chat_attachments WHERE sha256 = old.attachment_ref),
+                         inflate(old.attachment_summary)),
+                inflate(old.bot_text));
+        INSERT INTO chats_fts (rowid, username, user_text, attachment_summary, bot_text)
+        SELECT id, username, user_text, attachment_summary, bot_text FROM chats_text WHERE id = new.id;
+    END;
+    """,
+    # 10: an attached document's text is stored once per document (keyed by
+    # the upload's SHA-256) and the row keeps only its label; rows written by
+    # 9 (label and text together, keyed by their hash) read as before.
+    """
+    DROP VIEW IF EXISTS chats_text;
+    CREATE VIEW chats_text AS
+        SELECT c.id, c.username, inflate(c.user_text) AS user_text,
+               CASE WHEN c.attachment_ref IS NULL THEN inflate(c.attachment_summary)
+                     ELSE COALESCE(inflate(c.attachment_summary) || char(10), '')
+                          || (SELECT inflate(a.body) FROM chat_attachments a WHERE a.sha256 = c.attachment_ref) END AS attachment_summary,
+               inflate(c.bot_text) AS bot_text, c.created_at
+        FROM chats c;
+    DROP TRIGGER IF EXISTS chats_fts_delete;
+    DROP TRIGGER IF EXISTS chats_fts_update;
+    CREATE TRIGGER chats_fts_delete AFTER DELETE ON chats
+    WHEN old.id > (SELECT upto FROM chats_fts_backfill) OR old.id <= (SELECT done FROM chats_fts_backfill) BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, username, user_text, attachment_summary, bot_text)
+        VALUES ('delete', old.id, old.username, inflate(old.user_text),
+                CASE WHEN old.attachment_ref IS NULL THEN inflate(old.attachment_summary)
+                     ELSE COALESCE(inflate(old.attachment_summary) || char(10), '')
+                          || (SELECT inflate(a.body) FROM chat_attachments a WHERE a.sha256 = old.attachment_ref) END,
+                inflate(old.bot_text));
+    END;
+    CREATE TRIGGER chats_fts_update AFTER UPDATE ON chats
+    WHEN old.id > (SELECT upto FROM chats_fts_backfill) OR old.id <= (SELECT done FROM chats_fts_backfill) BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, username, user_text, attachment_summary, bot_text)
+        VALUES ('delete', old.id, old.username, inflate(old.user_text),
+                CASE WHEN old.attachment_ref IS NULL THEN inflate(old.attachment_summary)
+                     ELSE COALESCE(inflate(old.attachment_summary) || char(10), '')
+                          || (SELECT inflate(a.body) FROM chat_attachments a WHERE a.sha256 = old.attachment_ref) END,
+                inflate(old.bot_text));
+        INSERT INTO chats_fts (rowid, username, user_text, attachment_summary, bot_text)
+        SELECT id, username, user_text, attachment_summary, bot_text FROM chats_text WHERE id = new.id;
+    END;
+    """,
+]
+
+_pool = queue.LifoQueue()
+_migrated = False
+_migrate_lock = threading.Lock()
+_writer = None
+_writer_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+# ---- Compression -------------------------------------------------------------
+# Text of COMPRESS_MIN_BYTES or more is stored as a zlib BLOB; shorter text
+# stays TEXT, so the column type tells the two apart and old rows need no
+# rewrite. SQL reads go through inflate(), registered on every connection.
+def pack(text):
+    if text is None:
+        return None
+    raw = text.encode("utf-8")
+    return zlib.compress(raw, 6) if len(raw) >= COMPRESS_MIN_BYTES else text
+
+def inflate(value):
+    return zlib.decompress(value).decode("utf-8") if isinstance(value, bytes) else value
+
+# ---- Connections -------------------------------------------------------------
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
+    conn.create_function("inflate", 1, inflate, deterministic=True)
+    conn.execute("PRAGMA journal_mode=WAL")      # readers never block the writer
+    conn.execute("PRAGMA synchronous=NORMAL")    # fsync at checkpoint, safe under WAL
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-16000")     # 16 MB page cache per connection
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+@contextmanager
+def get_conn():
+    # Each thread borrows its own connection for the duration of the block and
+    # hands it back, so connections (and their page caches) outlive reruns.
+    migrate()
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        with conn:  # commit on success, rollback on error
+            yield conn
+    finally:
+        if _pool.qsize() < POOL_SIZE:
+            _pool.put(conn)
+        else:
+            conn.close()
+
+def migrate():
+    global _migrated
+    if _migrated:
+        return
+    with _migrate_lock:
+        if _migrated:
+            return
+        conn = _connect()
+        conn.isolation_level = None  # transactions below are explicit
+        try:
+            # The version is read under the write lock, so processes starting
+            # together apply each step once: the others wait, then see it done.
+            # executescript() would commit early, hence one statement at a time.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                    for statement in _statements(script):
+                        _apply(conn, statement)
+                    conn.execute(f"PRAGMA user_version={i}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        _migrated = True
+
+def _statements(script):
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            yield buf.strip()
+            buf = ""
+    if buf.strip():
+        yield buf.strip()
+
+_ADD_COLUMN = re.compile(r"ALTER\s+TABLE\s+(\w+)\s+ADD\s+COLUMN\s+(\w+)", re.IGNORECASE)
+
+def _apply(conn, statement):
+    # ADD COLUMN has no IF NOT EXISTS; skip it when the column is already there
+    m = _ADD_COLUMN.match(statement)
+    if m and any(col[1] == m.group(2) for col in conn.execute(f"PRAGMA table_info({m.group(1)})")):
+        return
+    conn.execute(statement)
+
+# ---- Users -------------------------------------------------------------------
+def insert_user(username, password):
+    try:
+        with get_conn() as conn:
+            conn.execute("INSERT INTO users VALUES (?, ?)", (username, password))
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+def user_exists(username, password):
+    with get_conn() as conn:
+        c = conn.execute("SELECT 1 FROM users WHERE username=? AND password=?", (username, password))
+        return c.fetchone() is not None
+
+# ---- Write-behind chat log --------------------------------------------------
+class ChatWriter:
+    """Background writer that batches chat rows into group commits.
+
+    Rows wait in a bounded in-memory queue and are flushed every `batch_rows`
+    rows or `interval_ms`, whichever comes first. `put` blocks while the queue
+    is full. Rows still queued when the process dies are lost; `synchronous`
+    ("OFF"/"NORMAL"/"FULL") sets how durable each flushed batch is.
+    """
+
+    def __init__(self, batch_rows=64, interval_ms=200, max_queue=10000, synchronous="NORMAL"):
+        self.batch_rows = batch_rows
+        self.interval = interval_ms / 1000
+        self.max_queue = max_queue
+        self.synchronous = synchronous
+        self._rows = []       # queued, not yet picked up by the writer
+        self._inflight = []   # picked up, not yet committed
+        self._cond = threading.Condition()
+        # Held across "read DB + read pending" and "commit + drop inflight" so a
+        # reader sees each row exactly once.
+        self._visible = threading.Lock()
+        self._flush = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("chat writer is closed")
+            self._cond.wait_for(lambda: len(self._rows) < self.max_queue or self._closed)
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_rows:
+                self._cond.notify_all()
+
+    def pending(self, username):
+        with self._cond:
+            return [r for r in self._inflight + self._rows if r[0] == username]
+
+    def flush(self):
+        with self._cond:
+            self._flush = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not self._rows and not self._inflight)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        conn = _connect()
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        try:
+            while True:
+                with self._cond:
+                    if not self._inflight:
+                        self._cond.wait_for(lambda: len(self._rows) >= self.batch_rows
+                                            or self._flush or self._closed, timeout=self.interval)
+                        self._inflight, self._rows = self._rows, []
+                        self._cond.notify_all()  # wake producers blocked on a full queue
+                    if not self._inflight:
+                        self._flush = False
+                        if self._closed:
+                            return
+                        continue
+                    batch = list(self._inflight)
+                try:
+                    _insert_chats(conn, batch)
+                    with self._visible:
+                        conn.commit()
+                        with self._cond:
+                            self._inflight = []
+                            self._cond.notify_all()
+                except sqlite3.Error:
+                    # Keep the batch in flight and retry; readers still see it as pending
+                    conn.rollback()
+                    log.exception("chat write-behind flush failed; retrying")
+                    time.sleep(self.interval)
+        finally:
+            conn.close()
+
+def enable_write_behind(batch_rows=64, interval_ms=200, max_queue=10000, synchronous="NORMAL"):
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            migrate()
+            _writer = ChatWriter(batch_rows, interval_ms, max_queue, synchronous)
+            atexit.register(_writer.close)
+    return _writer
+
+# ---- Chats -------------------------------------------------------------------
+def _insert_chats(conn, rows):
+    # rows: (username, user_text, attachment_summary, bot_text, document). Returns
+    # the last row id. With `document` (the upload's SHA-256) the summary is
+    # "label\ntext": the text goes to chat_attachments once per document and the
+    # row keeps the label. It is written first, so the insert trigger can index
+    # it through chats_text.
+    last = None
+    for username, user_text, attachment_summary, bot_text, document in rows:
+        label, ref = attachment_summary or None, None
+        if attachment_summary and document:
+            label, _, text = attachment_summary.partition("\n")
+            ref = document
+            conn.execute("INSERT OR IGNORE INTO chat_attachments (sha256, body) VALUES (?, ?)", (ref, pack(text)))
+        last = conn.execute("""INSERT INTO chats (username, user_text, attachment_summary, attachment_ref, bot_text)
+                               VALUES (?, ?, ?, ?, ?)""",
+                            (username, pack(user_text), pack(label), ref, pack(bot_text))).lastrowid
+    return last
+
+def save_chat_to_db(username, user_text, attachment_summary, bot_text, document=None):
+    # Returns the new row id, or None when the row was queued for write-behind
+    row = (username, user_text, attachment_summary, bot_text, document)
+    if _writer is not None:
+        _writer.put(row)
+        return None
+    with get_conn() as conn:
+        return _insert_chats(conn, [row])
+
+def load_chat_page(username, limit=50, before_id=None):
+    # Keyset pagination over (username, id): the newest `limit` turns older than
+    # `before_id`, returned oldest-first as (id, user_text, attachment_summary, bot_text).
+    # Rows still queued for write-behind are newest and carry id None.
+    if before_id is not None or _writer is None:
+        rows = _query_chat_page(username, limit, before_id)
+    else:
+        with _writer._visible:
+            rows = _query_chat_page(username, limit, before_id)
+            pending = [(None,) + r[1:4] for r in _writer.pending(username)]
+        rows = (rows + pending)[-limit:]
+    return rows
+
+def _query_chat_page(username, limit, before_id):
+    with get_conn() as conn:
+        if before_id is None:
+            c = conn.execute("""SELECT id, user_text, attachment_summary, bot_text
+                                FROM chats_text WHERE username=? ORDER BY id DESC LIMIT ?""",
+                             (username, limit))
+        else:
+            c = conn.execute("""SELECT id, user_text, attachment_summary, bot_text
+                                FROM chats_text WHERE username=? AND id<? ORDER BY id DESC LIMIT ?""",
+                             (username, before_id, limit))
+        rows = c.fetchall()
+    rows.reverse()
+    return rows
+
+def load_chat_turn(username, chat_id):
+    # One full turn (user_text, attachment_summary, bot_text), or None
+    with get_conn() as conn:
+        return conn.execute("SELECT user_text, attachment_summary, bot_text FROM chats_text WHERE id=? AND username=?",
+                            (chat_id, username)).fetchone()
+
+def load_chats_for_user(username, limit=200):
+    return [row[1:] for row in load_chat_page(username, limit)]
+
+def delete_user_chats(username):
+    # Also drops the user's upload refs; blobs nobody else uploaded are then
+    # removed by the next `python blobs.py --gc`
+    if _writer is not None:
+        _writer.flush()  # otherwise queued rows would land after the delete
+    with get_conn() as conn:
+        conn.execute("DELETE FROM chats WHERE username=?", (username,))
+        conn.execute("DELETE FROM chat_summaries WHERE username=?", (username,))
+        conn.execute("DELETE FROM blob_refs WHERE username=?", (username,))
+
+# ---- Rolling summaries -------------------------------------------------------
+def load_summary(username):
+    # (summary, id of the last turn it covers); ("", 0) when there is none
+    with get_conn() as conn:
+        row = conn.execute("SELECT summary, upto_id FROM chat_summaries WHERE username=?", (username,)).fetchone()
+    return row if row else ("", 0)
+
+def save_summary(username, summary, upto_id):
+    with get_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO chat_summaries (username, summary, upto_id) VALUES (?, ?, ?)",
+                     (username, summary, upto_id))